@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# Benchmark the main ugit operations on a generated repository.
+#
+#   python benchmarks/bench.py --files 2000 --depth 3 --commits 50 -o before.json
+#   ... change something in ugit ...
+#   python benchmarks/bench.py --files 2000 --depth 3 --commits 50 -o after.json --compare before.json
+#
+# The repository is generated from --seed, so two runs with the same options work on exactly the same files.
+# Every operation runs as its own 'python -m ugit ...' process, like a user would run it, and for each we record:
+#   wall          seconds from start to exit
+#   user, sys     CPU seconds spent in ugit / in the kernel on its behalf
+#   max_rss_kb    peak memory of the process
+#   in_blocks, out_blocks   blocks read from / written to disk by the kernel (0 if it all came from the page cache)
+#   ctx_switches  voluntary context switches, roughly how often the process waited on I/O or a lock
+#   objects_written         how many new files showed up in .ugit/objects (loose objects and packs)
+# With --repeat N the whole run is done N times, on a fresh repository each time, and the median is kept.
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) # the folder with the ugit package
+
+METRICS = ['wall', 'user', 'sys', 'max_rss_kb', 'in_blocks', 'out_blocks', 'ctx_switches', 'objects_written']
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=1000, help='number of files in the first commit')
+    parser.add_argument('--size', type=int, default=4096, help='average file size in bytes')
+    parser.add_argument('--depth', type=int, default=2, help='how many directory levels the files are spread over')
+    parser.add_argument('--fanout', type=int, default=8, help='subdirectories per directory')
+    parser.add_argument('--commits', type=int, default=20, help='length of the history')
+    parser.add_argument('--churn', type=float, default=0.02, help='share of the files changed by each commit')
+    parser.add_argument('--jobs', type=int, default=1, help='passed as -j to commit and checkout')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--keep', action='store_true', help='do not delete the generated repositories')
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare with')
+    return parser.parse_args()
+
+# Generated files are lines of hex digits: text (so diffs and deltas behave like on source code),
+# but still cheap to produce in large amounts
+def _random_text(rng, size):
+    text = rng.randbytes(max(size // 2, 1)).hex()
+    return '\n'.join(text[i:i + 63] for i in range(0, len(text), 63)).encode() + b'\n'
+
+def _random_path(rng, depth, fanout, i):
+    parts = [f'd{rng.randrange(fanout)}' for _ in range(depth)]
+    return os.path.join(*parts, f'file{i}.txt')
+
+def _write_file(path, content):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+# change one line of the file, or add a line at the end
+def _change_file(rng, path):
+    with open(path, 'rb') as f:
+        lines = f.read().split(b'\n')
+    line = rng.randbytes(32).hex().encode()
+    if len(lines) > 1 and rng.random() < 0.8:
+        lines[rng.randrange(len(lines) - 1)] = line
+    else:
+        lines.insert(-1, line)
+    with open(path, 'wb') as f:
+        f.write(b'\n'.join(lines))
+
+def _count_objects(repo):
+    count = 0
+    for _, _, filenames in os.walk(os.path.join(repo, '.ugit', 'objects')):
+        count += len(filenames)
+    return count
+
+# Run 'python -m ugit <args>' inside repo and return its measurements
+def _run_ugit(repo, *args):
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    objects_before = _count_objects(repo)
+    # posix_spawn + wait4 (instead of subprocess) to get the resource usage of exactly this one process
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    try:
+        start = time.perf_counter()
+        pid = os.posix_spawn(sys.executable, [sys.executable, '-m', 'ugit', *args], env,
+                             file_actions=[(os.POSIX_SPAWN_DUP2, devnull, 1)])
+        _, status, usage = os.wait4(pid, 0)
+        wall = time.perf_counter() - start
+    finally:
+        os.close(devnull)
+    assert os.waitstatus_to_exitcode(status) == 0, f'ugit {" ".join(args)} failed'
+    return {
+        'wall': wall,
+        'user': usage.ru_utime,
+        'sys': usage.ru_stime,
+        'max_rss_kb': usage.ru_maxrss,
+        'in_blocks': usage.ru_inblock,
+        'out_blocks': usage.ru_oublock,
+        'ctx_switches': usage.ru_nvcsw,
+        'objects_written': _count_objects(repo) - objects_before,
+    }
+
+def run_once(args, repo):
+    rng = random.Random(args.seed)
+    results = {}
+    jobs = ['-j', str(args.jobs)]
+
+    # the first version of every file
+    paths = []
+    for i in range(args.files):
+        path = os.path.join(repo, _random_path(rng, args.depth, args.fanout, i))
+        _write_file(path, _random_text(rng, rng.randint(args.size // 2, args.size * 3 // 2)))
+        paths.append(path)
+
+    os.chdir(repo)
+    results['init'] = _run_ugit(repo, 'init')
+    results['commit'] = _run_ugit(repo, 'commit', '-m', 'first', *jobs)
+    results['noop_commit'] = _run_ugit(repo, 'commit', '-m', 'nothing changed', *jobs)
+    _run_ugit(repo, 'branch', 'first')
+
+    # the history: every commit changes a few files and sometimes adds one
+    changed = max(1, int(args.files * args.churn))
+    history = []
+    for n in range(args.commits):
+        for path in rng.sample(paths, min(changed, len(paths))):
+            _change_file(rng, path)
+        if rng.random() < 0.3:
+            path = os.path.join(repo, _random_path(rng, args.depth, args.fanout, len(paths)))
+            _write_file(path, _random_text(rng, args.size))
+            paths.append(path)
+        history.append(_run_ugit(repo, 'commit', '-m', f'commit {n}', *jobs))
+    if history:
+        # the typical commit of an existing repository
+        results['incremental_commit'] = {metric: statistics.median(r[metric] for r in history) for metric in METRICS}
+
+    results['log'] = _run_ugit(repo, 'log')
+    results['show'] = _run_ugit(repo, 'show')
+    results['checkout'] = _run_ugit(repo, 'checkout', 'first', *jobs) # back to the first commit
+    results['checkout_back'] = _run_ugit(repo, 'checkout', 'master', *jobs)
+    return results
+
+def run(args):
+    runs = []
+    cwd = os.getcwd()
+    for i in range(args.repeat):
+        repo = tempfile.mkdtemp(prefix='ugit-bench-')
+        try:
+            runs.append(run_once(args, repo))
+        finally:
+            os.chdir(cwd)
+            if args.keep:
+                print(f'repository kept in {repo}')
+            else:
+                shutil.rmtree(repo)
+
+    results = {}
+    for op in runs[0]:
+        results[op] = {metric: statistics.median(r[op][metric] for r in runs) for metric in METRICS}
+    return results
+
+def print_results(results, old=None):
+    header = f'{"operation":<20}{"wall s":>10}{"user s":>9}{"sys s":>8}{"rss MB":>8}{"in blk":>9}{"out blk":>9}{"objects":>9}'
+    if old:
+        header += f'{"old wall s":>12}{"change":>9}'
+    print(header)
+    for op, r in results.items():
+        line = (f'{op:<20}{r["wall"]:>10.3f}{r["user"]:>9.3f}{r["sys"]:>8.3f}{r["max_rss_kb"] / 1024:>8.1f}'
+                f'{r["in_blocks"]:>9.0f}{r["out_blocks"]:>9.0f}{r["objects_written"]:>9.0f}')
+        if old and op in old:
+            old_wall = old[op]['wall']
+            line += f'{old_wall:>12.3f}{(r["wall"] - old_wall) / old_wall * 100:>+8.1f}%'
+        print(line)
+
+def main():
+    args = parse_args()
+    config = {name: getattr(args, name) for name in ('files', 'size', 'depth', 'fanout', 'commits', 'churn', 'jobs', 'seed', 'repeat')}
+    results = run(args)
+
+    old = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        if previous['config'] != config:
+            print(f'warning: {args.compare} was run with different options: {previous["config"]}')
+        old = previous['results']
+    print_results(results, old)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'config': config,
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'results': results,
+            }, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# Measure how long starting ugit takes, using Python's own import timer (python -X importtime).
+# Hooks and scripts call ugit over and over, so most of the time of a small command is spent importing modules.
+#
+#   python benchmarks/startup.py                          -> time 'import ugit.cli'
+#   python benchmarks/startup.py -- cat-file --batch      -> time everything 'ugit cat-file --batch' imports
+#   python benchmarks/startup.py --budget 25              -> exit with 1 if ugit takes more than 25 ms
+#
+# The command is run in the current directory (so run it inside a ugit repository for commands that need one),
+# with stdin closed. Times are the best of --repeat runs, minus what a bare 'python -c pass' imports.
+
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) # the folder with the ugit package
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--budget', type=float, help='fail if ugit adds more than this many ms')
+    parser.add_argument('--top', type=int, default=10, help='how many of the slowest modules to list')
+    parser.add_argument('command', nargs='*', help='ugit command to run (default: only import ugit.cli)')
+    return parser.parse_args()
+
+# Run python with -X importtime and return {module: (self us, cumulative us, depth)}
+def import_times(code):
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                          stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=env)
+    times = {}
+    for line in proc.stderr.decode().splitlines():
+        # import time:       336 |      42522 | ugit.cli
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2 # two spaces per level
+        times[name.strip()] = (int(self_us), int(cumulative_us), depth)
+    return times
+
+# Time spent in top level imports (everything below them is included in their cumulative time)
+def total(times):
+    return sum(cumulative for _, cumulative, depth in times.values() if depth == 0)
+
+def best_of(code, repeat):
+    runs = [import_times(code) for _ in range(repeat)]
+    return min(runs, key=total)
+
+def main():
+    args = parse_args()
+    if args.command:
+        code = f'import sys; sys.argv = {["ugit"] + args.command!r}; from ugit.cli import main; main()'
+    else:
+        code = 'import ugit.cli'
+
+    baseline = best_of('pass', args.repeat) # site, encodings... python imports those for every script
+    times = best_of(code, args.repeat)
+    extra = {name: t for name, t in times.items() if name not in baseline}
+    ugit_ms = (total(times) - total(baseline)) / 1000
+
+    print(f'{"self ms":>8} {"cumul ms":>9}  module')
+    slowest = sorted(extra.items(), key=lambda item: item[1][0], reverse=True)[:args.top]
+    for name, (self_us, cumulative_us, depth) in slowest:
+        print(f'{self_us / 1000:8.2f} {cumulative_us / 1000:9.2f}  {name}')
+    print(f'\n{len(extra)} modules imported, {ugit_ms:.2f} ms on top of a bare python start')
+
+    if args.budget is not None and ugit_ms > args.budget:
+        print(f'over budget: {ugit_ms:.2f} ms > {args.budget:.2f} ms')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
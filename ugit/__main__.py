@@ -0,0 +1,4 @@
+# Allows running ugit as 'python -m ugit ...', same as the 'ugit' script installed by setup.py
+from .cli import main
+
+main()
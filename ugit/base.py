@@ -1,21 +1,75 @@
 # For basic higher-level logic for ugit
 # For example, using the object database implemented in data.py to implement higher-level structures for storing directories
 
+import functools
 import itertools
 import operator
 import os
+import stat
 import string
 
 from collections import deque, namedtuple
 
+from . import bloom
 from . import data
+from . import trace
+# concurrent.futures and watch are imported by the functions that need them,
+# so commands that never hash the working tree (log, cat-file, show...) start faster
 
 def init():
     data.init()
     data.update_ref('HEAD', data.RefValue(symbolic=True, value='refs/heads/master'))
 
 # Take a snapshot of current working dir and make tree file(s) out of that
-def write_tree(directory='.'):
+# With jobs > 1, files are read and hashed by that many threads while the directories are still being scanned,
+# the tree objects are then put together bottom-up once all their children are done.
+# The result is exactly the same as with jobs=1.
+# If 'ugit watch' is running, only the paths it saw changing since the last write_tree are looked at,
+# the rest of the tree comes from the index.
+# Directories without any files are not part of the snapshot (read_tree could not bring them back anyway).
+@trace.timed('write_tree')
+def write_tree(directory='.', jobs=1):
+    import concurrent.futures
+    from . import watch
+    state = data.read_index_state()
+    changes = watch.query(state.watch_token) if directory == '.' else None
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        if jobs > 1:
+            # hashlib and file reads release the GIL, so threads really do hash on several cores
+            hash_path = lambda full: executor.submit(_hash_path, full)
+        else:
+            hash_path = _hash_path
+        
+        if changes and not changes.full:
+            with trace.span('refresh_entries'):
+                new_index = _refresh_entries(state.entries, set(changes.paths) | set(state.racy), hash_path)
+            with trace.span('build_trees'):
+                oid = _build_tree_from_files({path: entry.oid for path, entry in new_index.items()})
+        else:
+            new_index = {}
+            with trace.span('scan'):
+                entries = _scan_tree(directory, state.entries, hash_path)
+            with trace.span('build_trees'): # includes waiting for the hashing threads
+                oid = _build_tree(entries, new_index)
+    
+    if oid is None:
+        oid = data.hash_object(b'', type_='tree') # nothing to snapshot, empty tree
+    token = changes.token if changes else None
+    if new_index != state.entries or token != state.watch_token:
+        data.write_index(new_index, watch_token=token)
+    return oid
+
+@trace.timed('hash_file')
+def _hash_path(full):
+    with open(full, 'rb') as f:
+        return data.hash_file(f, 'blob')
+
+# Walk the directory and return its entries as a list of (name, type_, value, path, stat), where value is
+#   - for a tree: the list of entries of the subdirectory (same format, recursively)
+#   - for a blob: its oid, taken from the index (stat cache) if the file didn't change,
+#     otherwise whatever hash_path(full) returns (the oid itself, or a Future of it when hashing in a thread pool)
+def _scan_tree(directory, index, hash_path):
     entries = []
     with os.scandir(directory) as it:
         for entry in it:
@@ -26,30 +80,137 @@ def write_tree(directory='.'):
                 # follow_symlinks=False -> do not follow symbolic links
                 # for example, if the entry is a symlink to a file, we do not want to follow it
                 # or, potentially, create a loop
-                type_ = 'blob'
-                with open(full, 'rb') as f:
-                    oid = data.hash_object(f.read(), type_)
+                path = os.path.normpath(full) # './dir/file' -> 'dir/file'
+                st = entry.stat(follow_symlinks=False)
+                cached = index.get(path)
+                if data.index_entry_matches(cached, st):
+                    oid = cached.oid # unchanged since last snapshot, no need to read it again
+                    trace.count('index_hits')
+                else:
+                    oid = hash_path(full)
+                    trace.count('index_misses')
+                entries.append((entry.name, 'blob', oid, path, st))
             elif entry.is_dir(follow_symlinks=False):
-                type_ = 'tree'
-                oid = write_tree(full) # Recursively call write_tree for subdirectories
-            entries.append((entry.name, oid, type_))
-            # Append the entry list with the (name, oid, type_) tuple
-            
-    tree=''.join(f'{type_} {oid} {name}\n' for name, oid, type_ in sorted(entries))
+                subtree = _scan_tree(full, index, hash_path) # Recursively scan subdirectories
+                entries.append((entry.name, 'tree', subtree, None, None))
+    return entries
+
+# Turn what _scan_tree returned into tree objects, children first, and return the oid of the top one
+# (None if there are no files in it at all).
+# new_index collects the index entries of all files for the next write_tree
+def _build_tree(entries, new_index):
+    import concurrent.futures
+    tree_entries = []
+    for name, type_, value, path, st in entries:
+        if type_ == 'tree':
+            oid = _build_tree(value, new_index)
+            if oid is None:
+                continue # no files below this directory
+        else:
+            oid = value.result() if isinstance(value, concurrent.futures.Future) else value
+            new_index[path] = data.index_entry(st, oid)
+        tree_entries.append((name, oid, type_))
+        # Append the entry list with the (name, oid, type_) tuple
+    return _hash_tree(tree_entries)
+
+def _hash_tree(tree_entries): # [(name, oid, type_)]
+    if not tree_entries:
+        return None
+    tree=''.join(f'{type_} {oid} {name}\n' for name, oid, type_ in sorted(tree_entries))
     # Sort entries by name and format them as 'type oid name\n'
     # to make sure that the tree is consistent and does not messed up the hash
     return data.hash_object(tree.encode(), type_='tree')
+
+# Same result as _build_tree, but from a flat {'dir/file': oid} dict
+def _build_tree_from_files(files):
+    root = {}
+    for path, oid in files.items():
+        *dirnames, filename = path.split('/')
+        node = root
+        for dirname in dirnames:
+            node = node.setdefault(dirname, {})
+        node[filename] = oid
+    # root is now nested dicts, e.g. {'a.txt': 'oid1', 'dir': {'b.txt': 'oid2'}}
+    return _build_tree_from_nested(root)
+
+def _build_tree_from_nested(node):
+    tree_entries = []
+    for name, value in node.items():
+        if isinstance(value, dict):
+            tree_entries.append((name, _build_tree_from_nested(value), 'tree'))
+        else:
+            tree_entries.append((name, value, 'blob'))
+    return _hash_tree(tree_entries)
+
+# Update the index entries of the last scan for the paths that changed since then (as reported by 'ugit watch'),
+# returns {path: IndexEntry} for every file in the working directory.
+# A changed path can be a file (re-hashed if its stat data changed) or a directory (scanned again completely)
+def _refresh_entries(entries, changed_paths, hash_path):
+    import concurrent.futures
+    new_entries = dict(entries)
+    to_check = {} # path -> stat of the files to compare against the index
+    directories = []
+    for path in changed_paths:
+        if is_ignored(path):
+            continue
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            st = None
+        if st is not None and stat.S_ISREG(st.st_mode):
+            to_check[path] = st
+            continue
+        new_entries.pop(path, None) # deleted, or not a file anymore
+        if st is None or stat.S_ISDIR(st.st_mode):
+            directories.append(path)
+    
+    if directories:
+        # a directory might have been deleted, created or moved as a whole: forget everything below it
+        # and look at what is in there now
+        prefixes = tuple('' if directory == '.' else f'{directory}/' for directory in directories)
+        for path in [path for path in new_entries if path.startswith(prefixes)]:
+            del new_entries[path]
+        for directory in directories:
+            if os.path.isdir(directory):
+                to_check.update(_iter_files(directory))
+    
+    pending = []
+    for path, st in to_check.items():
+        cached = entries.get(path)
+        if data.index_entry_matches(cached, st):
+            new_entries[path] = cached
+            trace.count('index_hits')
+        else:
+            pending.append((path, st, hash_path(path)))
+            trace.count('index_misses')
+    for path, st, oid in pending:
+        if isinstance(oid, concurrent.futures.Future):
+            oid = oid.result()
+        new_entries[path] = data.index_entry(st, oid)
+    return new_entries
                 
 # _iter_tree_entries is a generator that will take an OID of a tree
 # tokenize it line-by-line and yield the raw string values.
 def _iter_tree_entries(oid):
     if not oid:
         return
+    yield from _read_tree_entries(oid)
+
+# Objects never change once written, so parsed trees and commits can be kept in memory and reused
+# (history walks and get_tree on many commits keep running into the same ones).
+# lru_cache keeps the most recently used ones and counts hits/misses, see cache_info()
+TREE_CACHE_SIZE = 4096
+COMMIT_CACHE_SIZE = 4096
+
+@functools.lru_cache(maxsize=TREE_CACHE_SIZE)
+def _read_tree_entries(oid):
     tree = data.get_object(oid,'tree')
+    entries = []
     for entry in tree.decode().splitlines():
         type_, oid, name = entry.split(' ', 2)
         # each entry in a tree file should look like: <type> <oid> <name>
-        yield type_, oid, name
+        entries.append((type_, oid, name))
+    return tuple(entries) # a tuple, so nobody can modify the cached value
         
 # get_tree uses _iter_tree_entries to recursively parse a tree into a dictionary.
 def get_tree(oid,base_path=''):
@@ -72,6 +233,108 @@ def get_tree(oid,base_path=''):
     #   ...
     # }
 
+# Compare the working directory with the tree of HEAD and return (modified, added, deleted),
+# three sorted lists of paths. Files whose stat data matches the index are not read at all,
+# the others are hashed (without writing them to the object store).
+# Directories are scanned and files hashed by `jobs` threads.
+@trace.timed('status')
+def get_working_tree_changes(jobs=1):
+    import concurrent.futures
+    from . import watch
+    HEAD = data.get_ref('HEAD').value
+    head_tree = get_tree(get_commit(HEAD).tree) if HEAD else {}
+    state = data.read_index_state()
+    changes = watch.query(state.watch_token)
+    
+    working_tree = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        if changes and not changes.full:
+            # 'ugit watch' knows what changed since the index was written, no need to walk the whole tree
+            entries = _refresh_entries(state.entries, set(changes.paths) | set(state.racy),
+                                       lambda path: executor.submit(_hash_path_oid, path))
+            working_tree = {path: entry.oid for path, entry in entries.items()}
+        else:
+            pending = [] # (path, Future of its oid) for the files that have to be hashed
+            with trace.span('scan'):
+                for path, st in _walk_files(executor):
+                    cached = state.entries.get(path)
+                    if data.index_entry_matches(cached, st):
+                        working_tree[path] = cached.oid
+                        trace.count('index_hits')
+                    else:
+                        pending.append((path, executor.submit(_hash_path_oid, path)))
+                        trace.count('index_misses')
+            with trace.span('wait_for_hashing'):
+                for path, future in pending:
+                    working_tree[path] = future.result()
+    
+    modified = [path for path, oid in working_tree.items() if path in head_tree and head_tree[path] != oid]
+    added = [path for path in working_tree if path not in head_tree]
+    deleted = [path for path in head_tree if path not in working_tree]
+    return sorted(modified), sorted(added), sorted(deleted)
+
+@trace.timed('hash_file')
+def _hash_path_oid(path):
+    with open(path, 'rb') as f:
+        return data.hash_file_oid(f)
+
+# yields (path, stat) of every file in the working directory (paths like 'dir/file', same as in the index).
+# Every directory is listed by a task on the executor, the subdirectories it finds are submitted as new tasks
+def _walk_files(executor):
+    pending = deque([executor.submit(_list_directory, '.')])
+    while pending:
+        files, subdirectories = pending.popleft().result()
+        pending.extend(executor.submit(_list_directory, subdirectory) for subdirectory in subdirectories)
+        yield from files
+
+# same as _walk_files, but serial and only below one directory
+def _iter_files(directory):
+    files, subdirectories = _list_directory(directory)
+    yield from files
+    for subdirectory in subdirectories:
+        yield from _iter_files(subdirectory)
+
+def _list_directory(directory):
+    files, subdirectories = [], []
+    with os.scandir(directory) as it:
+        for entry in it:
+            full = f'{directory}/{entry.name}'
+            if is_ignored(full):
+                continue
+            if entry.is_file(follow_symlinks=False):
+                files.append((os.path.normpath(full), entry.stat(follow_symlinks=False)))
+            elif entry.is_dir(follow_symlinks=False):
+                subdirectories.append(full)
+    return files, subdirectories
+
+# Compare two trees (by oid) and yield (path, oid_from, oid_to) for every blob that differs,
+# None on one side means the file doesn't exist in that tree.
+# Both trees are walked side by side and a subtree with the same oid on both sides is skipped
+# without even being read, so the cost depends on how much changed, not on the size of the trees.
+def iter_tree_changes(tree_from, tree_to, base_path=''):
+    if tree_from == tree_to:
+        return
+    entries_from = {name: (type_, oid) for type_, oid, name in _iter_tree_entries(tree_from)}
+    entries_to = {name: (type_, oid) for type_, oid, name in _iter_tree_entries(tree_to)}
+    
+    for name in sorted(entries_from.keys() | entries_to.keys()):
+        type_from, oid_from = entries_from.get(name, (None, None))
+        type_to, oid_to = entries_to.get(name, (None, None))
+        if (type_from, oid_from) == (type_to, oid_to):
+            continue # same file or same subtree, nothing changed below here
+        path = base_path + name
+        
+        # a name can be a file on one side and a directory on the other, so look at blobs and trees separately
+        blob_from = oid_from if type_from == 'blob' else None
+        blob_to = oid_to if type_to == 'blob' else None
+        if blob_from != blob_to:
+            yield path, blob_from, blob_to
+        
+        subtree_from = oid_from if type_from == 'tree' else None
+        subtree_to = oid_to if type_to == 'tree' else None
+        if subtree_from != subtree_to:
+            yield from iter_tree_changes(subtree_from, subtree_to, base_path=path + '/')
+
 # remove everything in the current dir for new read_tree()
 def _empty_current_directory():
     for root, dirnames, filenames in os.walk('.', topdown = False):
@@ -98,16 +361,77 @@ def _empty_current_directory():
             
 # read_tree uses get_tree to get the file OIDs
 # and writes them into the working directory.
-def read_tree(tree_oid):
-    _empty_current_directory()
-    # Clear the current directory before writing the tree
-    for path, oid in get_tree(tree_oid, base_path = './').items():
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open (path, 'wb') as f:
-            f.write(data.get_object(oid))
+# If base_tree (the tree currently checked out) is given, only the paths that differ
+# between base_tree and tree_oid are touched, everything else is left alone (mtimes included).
+# With jobs > 1 the files are read from the object store and written by that many threads.
+@trace.timed('read_tree')
+def read_tree(tree_oid, base_tree=None, jobs=1):
+    index = data.read_index()
+    if base_tree is None:
+        _empty_current_directory()
+        # Clear the current directory before writing the tree
+        index = {}
+        to_remove = []
+        with trace.span('read_trees'):
+            to_write = get_tree(tree_oid)
+    else:
+        to_remove = []
+        to_write = {}
+        with trace.span('compare_trees'):
+            for path, o_from, o_to in iter_tree_changes(base_tree, tree_oid):
+                if o_to is None:
+                    to_remove.append(path)
+                else:
+                    to_write[path] = o_to
+    
+    # remove first: a deleted file 'x' might become a directory 'x/' in the new tree or the other way around
+    with trace.span('remove_files'):
+        for path in to_remove:
+            index.pop(path, None)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            _remove_empty_parents(path)
+    
+    # create every directory once up front, so the workers below only have to write files
+    for directory in sorted({os.path.dirname(f'./{path}') for path in to_write}):
+        os.makedirs(directory, exist_ok=True)
+    
+    with trace.span('write_files'):
+        if jobs > 1:
+            import concurrent.futures
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+                # reading objects and writing files mostly waits on the disk (the GIL is released),
+                # so threads can keep many of them in flight at once
+                entries = executor.map(_write_blob, to_write.keys(), to_write.values())
+                index.update(zip(to_write.keys(), entries))
+        else:
+            for path, oid in to_write.items():
+                index[path] = _write_blob(path, oid)
+    data.write_index(index)
+
+# write one blob to the working directory and return its index entry
+@trace.timed('write_file')
+def _write_blob(path, oid):
+    with open (path, 'wb') as f:
+        data.copy_object(oid, f) # streamed, so checking out a huge file doesn't need that much memory
+    # remember the stat data of the file we just wrote, so the next write_tree doesn't need to hash it
+    return data.index_entry(os.stat(path), oid)
+
+def _remove_empty_parents(path):
+    parent = os.path.dirname(path)
+    while parent:
+        try:
+            os.rmdir(parent)
+        except OSError:
+            break # not empty (or ignored files inside), so its parents aren't empty either
+        parent = os.path.dirname(parent)
         
-def commit(message):
-    commit = f'tree {write_tree()}\n'
+@trace.timed('commit')
+def commit(message, jobs=1):
+    tree = write_tree(jobs=jobs)
+    commit = f'tree {tree}\n'
     
     HEAD = data.get_ref('HEAD').value
     if HEAD:
@@ -117,14 +441,68 @@ def commit(message):
     commit += f'{message}\n'
     
     oid = data.hash_object(commit.encode(), type_='commit')
+    _add_to_commit_graph(oid, tree, HEAD)
+    data.append_bloom_filter(oid, _changed_paths_filter(tree, HEAD))
     data.update_ref('HEAD', data.RefValue(symbolic=False,value=oid))
     return oid
 
+# keep the commit-graph up to date with new commits, as long as the history below them is in it too
+def _add_to_commit_graph(oid, tree, parent):
+    if parent:
+        parent_commit = data.read_commit_graph(parent)
+        if not parent_commit:
+            return # the graph doesn't cover this history (yet), 'ugit commit-graph' will add it
+        generation = parent_commit.generation + 1
+    else:
+        generation = 1
+    data.append_commit_graph(oid, data.GraphCommit(tree=tree, parent=parent, generation=generation))
+
+# (re)write the commit-graph with every commit reachable from a ref, returns the number of commits in it
+@trace.timed('write_commit_graph')
+def write_commit_graph():
+    tips = {ref.value for _, ref in data.iter_refs(deref=False) if not ref.symbolic and ref.value}
+    commits = {oid: get_commit(oid) for oid in iter_commits_and_parents(tips)}
+    
+    generations = {}
+    for oid in commits:
+        # go down the history until a commit whose generation is known (or the root),
+        # then number the commits on the way back up
+        chain = []
+        while oid and oid not in generations:
+            chain.append(oid)
+            oid = commits[oid].parent
+        generation = generations[oid] if oid else 0
+        for oid in reversed(chain):
+            generation += 1
+            generations[oid] = generation
+    
+    data.write_commit_graph({
+        oid: data.GraphCommit(tree=commit.tree, parent=commit.parent, generation=generations[oid])
+        for oid, commit in commits.items()})
+    
+    # changed-path filters for the commits made before filters existed (the others already have one)
+    filters = {}
+    for oid, commit in commits.items():
+        filters[oid] = data.read_bloom_filter(oid)
+        if filters[oid] is None:
+            filters[oid] = _changed_paths_filter(commit.tree, commit.parent)
+    data.write_bloom_filters(filters)
+    return len(commits)
+
+# the changed-path Bloom filter (see bloom.py) of a commit with this tree and parent
+def _changed_paths_filter(tree, parent):
+    parent_tree = get_commit_tree(parent) if parent else None
+    # iter_tree_changes only opens the subtrees that differ, so this is cheap for a typical commit
+    return bloom.create(path for path, _, _ in iter_tree_changes(parent_tree, tree))
+
 # call read_tree and set HEAD to the commit OID
-def checkout (name): # name could be and OID or a branch name
+@trace.timed('checkout')
+def checkout (name, jobs=1): # name could be and OID or a branch name
     oid = get_oid(name)
     commit = get_commit(oid)
-    read_tree(commit.tree)
+    HEAD = data.get_ref('HEAD').value
+    # only touch the files that differ between the current commit and the new one
+    read_tree(commit.tree, base_tree=get_commit(HEAD).tree if HEAD else None, jobs=jobs)
     
     if is_branch(name):
         HEAD = data.RefValue(symbolic=True, value=f'refs/heads/{name}')
@@ -163,11 +541,15 @@ def iter_branch_name():
 def is_branch(branch):
     return data.get_ref(f'refs/heads/{branch}').value is not None
 
+@functools.lru_cache(maxsize=COMMIT_CACHE_SIZE)
 def get_commit(oid):
+    return _parse_commit(oid, data.get_object(oid, expected='commit'))
+
+def _parse_commit(oid, commit):
+    tree = None
     parent = None
     
-    commit = data.get_object(oid, expected='commit').decode()
-    lines = iter(commit.splitlines())
+    lines = iter(commit.decode().splitlines())
     for line in itertools.takewhile(operator.truth, lines):
         # takewhile will stop when encountering an empty line
         key, value = line.split(' ', 1)
@@ -183,6 +565,10 @@ def get_commit(oid):
     return Commit(tree=tree, parent=parent, message=message)
     # Commit(<tree_oid>, <parent_oid>, <message>
 
+# hit/miss statistics of the commit and tree caches
+def cache_info():
+    return {'commits': get_commit.cache_info(), 'trees': _read_tree_entries.cache_info()}
+
 def iter_commits_and_parents(oids):
     oids = deque(oids)
     visited = set()
@@ -196,12 +582,208 @@ def iter_commits_and_parents(oids):
         visited.add(oid)
         yield oid
         
-        commit = get_commit(oid)
-        oids.appendleft(commit.parent)
+        oids.appendleft(get_parent(oid))
+
+# the parent of a commit, from the commit-graph when possible, so the commit object doesn't need to be read
+def get_parent(oid):
+    graph_commit = data.read_commit_graph(oid)
+    if graph_commit:
+        return graph_commit.parent
+    return get_commit(oid).parent
+
+# same for the tree of a commit
+def get_commit_tree(oid):
+    graph_commit = data.read_commit_graph(oid)
+    if graph_commit:
+        return graph_commit.tree
+    return get_commit(oid).tree
+
+# Like iter_commits_and_parents, but only yields the commits that changed one of the paths
+# (files or directories, e.g. 'dir/file.txt' or 'dir') compared to their parent. It's a generator,
+# so 'log --max-count' stops walking the history as soon as it has enough commits.
+# The Bloom filter of a commit rules it out without reading any of its trees,
+# only the commits it says "maybe" for (or that have no filter) get their trees compared
+def iter_commits_touching(oids, paths):
+    paths = [_normalize_path(path) for path in paths]
+    for oid in iter_commits_and_parents(oids):
+        bits = data.read_bloom_filter(oid)
+        if bits is not None and not any(_maybe_changed(bits, path) for path in paths):
+            trace.count('bloom_filter_negatives')
+            continue
+        trace.count('bloom_filter_maybes' if bits is not None else 'bloom_filter_missing')
+        
+        tree = get_commit_tree(oid)
+        parent = get_parent(oid)
+        parent_tree = get_commit_tree(parent) if parent else None
+        if any(_tree_entry(tree, path) != _tree_entry(parent_tree, path) for path in paths):
+            yield oid
+        elif bits is not None:
+            trace.count('bloom_filter_false_positives')
+
+def _normalize_path(path):
+    path = os.path.normpath(path) # './dir//file' -> 'dir/file'
+    return '' if path == '.' else path # '' is the whole tree
+
+def _maybe_changed(bits, path):
+    if not path:
+        return bool(bits) # the whole tree changed unless the commit changed nothing at all
+    return bloom.maybe_contains(bits, path)
+
+# (type_, oid) of whatever is at path ('dir/file.txt') in the tree, None if there's nothing there
+def _tree_entry(tree, path):
+    entry = ('tree', tree)
+    for name in path.split('/') if path else []:
+        if entry[0] != 'tree' or not entry[1]:
+            return None # a file where a directory should be, or no tree at all
+        entry = next(((type_, oid) for type_, oid, entry_name in _iter_tree_entries(entry[1]) if entry_name == name), None)
+        if entry is None:
+            return None
+    return entry
+
+# Every object reachable from the refs (through commits, their parents and their trees) and from the index,
+# as a set of raw 32-byte oids (half the memory of hex strings, which matters with millions of objects).
+# Each tree is only opened once, however many commits share it.
+# Objects that should be there but aren't are appended to `missing` if it's given, otherwise it's an error
+def mark_reachable(missing=None):
+    reachable = set()
+    
+    def mark(oid):
+        raw = bytes.fromhex(oid)
+        if raw in reachable:
+            return False
+        reachable.add(raw)
+        return True
+    
+    def lost(oid):
+        assert missing is not None, f'Object {oid} is missing, run ugit fsck'
+        missing.append(oid)
+    
+    def damaged(oid):
+        # gc can't know what a damaged object refers to, deleting anything now could lose data.
+        # fsck has already reported it, so it just goes on
+        assert missing is not None, f'Object {oid} is damaged, run ugit fsck'
+    
+    commits = [ref.value for _, ref in data.iter_refs(deref=False) if not ref.symbolic and ref.value]
+    trees = []
+    while commits:
+        oid = commits.pop()
+        if not oid or not mark(oid):
+            continue # root commit, or its history was already walked from another ref
+        try:
+            trees.append(get_commit_tree(oid))
+            commits.append(get_parent(oid))
+        except FileNotFoundError:
+            lost(oid) # everything behind a missing commit is lost too
+        except (ValueError, AssertionError):
+            damaged(oid)
+    
+    # go down the trees with a stack instead of recursion, a subtree already marked is skipped with everything below it
+    while trees:
+        tree = trees.pop()
+        if not mark(tree):
+            continue
+        try:
+            entries = _read_tree_entries(tree)
+        except FileNotFoundError:
+            lost(tree)
+            continue
+        except ValueError:
+            damaged(tree)
+            continue
+        for type_, oid, _ in entries:
+            if type_ == 'tree':
+                trees.append(oid)
+            elif mark(oid) and missing is not None and not data.object_exists(oid):
+                lost(oid) # only checked for fsck, gc doesn't need to stat every blob
+    
+    # files hashed by write_tree are reused from the index by the next commit without being written again
+    for entry in data.read_index().values():
+        mark(entry.oid)
+    return reachable
+
+# Re-read every stored object (loose and packed copies), check that it still hashes to its oid
+# and that trees and commits can be parsed. Yields (oid, problem) for the damaged ones.
+# With jobs > 1 the objects are checked in batches by that many processes (hashing and parsing are CPU-bound,
+# threads would take turns on the GIL). Only a few batches are in flight at once,
+# so memory stays the same however many objects there are
+FSCK_BATCH_SIZE = 512
+
+def fsck(jobs=1):
+    objects = itertools.chain(((oid, False) for oid in data.iter_loose_objects()),
+                              ((oid, True) for oid in data.iter_packed_objects()))
+    batches = iter(lambda: list(itertools.islice(objects, FSCK_BATCH_SIZE)), [])
+    # iter(callable, sentinel) keeps taking the next FSCK_BATCH_SIZE objects until there are none left
+    if jobs <= 1:
+        for batch in batches:
+            yield from _fsck_batch(batch)
+        return
+    
+    import concurrent.futures
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = deque()
+        for batch in batches:
+            pending.append(executor.submit(_fsck_batch, batch))
+            if len(pending) >= jobs * 2: # enough to keep every worker busy
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+def _fsck_batch(batch): # [(oid, packed)], runs in a worker process
+    problems = []
+    for oid, packed in batch:
+        where = 'packed' if packed else 'loose'
+        try:
+            type_, content = data.verify_object(oid, packed)
+            _check_object_format(oid, type_, content)
+        except (OSError, ValueError, AssertionError) as e:
+            problems.append((oid, f'{where} object is damaged: {e}'))
+    return problems
+
+def _check_object_format(oid, type_, content):
+    if type_ == 'blob':
+        return
+    if type_ == 'tree':
+        for entry in content.decode().splitlines():
+            type_, entry_oid, name = entry.split(' ', 2)
+            assert type_ in ('blob', 'tree'), f'unknown entry type {type_}'
+            assert len(entry_oid) == 64 and all(c in string.hexdigits for c in entry_oid), f'bad oid {entry_oid}'
+            assert name and '/' not in name and name not in ('.', '..'), f'bad name {name!r}'
+    elif type_ == 'commit':
+        assert _parse_commit(oid, content).tree, 'no tree'
+    else:
+        assert False, f'unknown type {type_}'
+
+# Delete the objects nothing refers to anymore (see mark_reachable): loose ones older than `expire`
+# (a time.time() value) are deleted, packs older than that are rewritten without them.
+# Returns (number of loose objects deleted, number of packed objects dropped)
+def gc(expire):
+    reachable = mark_reachable()
+    is_reachable = lambda oid: bytes.fromhex(oid) in reachable
+    pruned = data.prune_loose_objects(is_reachable, expire)
+    
+    drop = {oid for oid in data.iter_old_packed_objects(expire) if not is_reachable(oid)}
+    drop -= set(data.iter_loose_objects()) # a young loose copy keeps the object alive
+    # only the packs holding some of them are rewritten, loose objects were taken care of above
+    dropped = data.prune_packs(drop, expire) if drop else 0
+    return pruned, dropped
 
 # here name could be a name tagged to some refs, then we should find the referenced OID
 # or if name is OID itself -> no need to find anything
+# Names are resolved once and remembered until a ref changes (data.ref_epoch),
+# argparse alone calls get_oid for every oid argument
+_oid_cache = {}
+_oid_cache_epoch = None
+
 def get_oid(name):
+    global _oid_cache_epoch
+    if _oid_cache_epoch != data.ref_epoch:
+        _oid_cache.clear()
+        _oid_cache_epoch = data.ref_epoch
+    if name not in _oid_cache:
+        _oid_cache[name] = _resolve_oid(name)
+    return _oid_cache[name]
+
+def _resolve_oid(name):
     if name =='@': name =  'HEAD'
     
     # name is ref
@@ -212,16 +794,26 @@ def get_oid(name):
         f'refs/heads/{name}', # needed for future change
     ]
     for ref in refs_to_try:
-        if data.get_ref(ref, deref=False).value:
-            return data.get_ref(ref).value
+        ref_value = data.get_ref(ref, deref=False)
+        if ref_value.value:
+            return data.get_ref(ref).value if ref_value.symbolic else ref_value.value
     
     # name is SHA256 (OID)
-    is_hex = all(c in string.hexdigits for c in name) and len(name) == 64
-    # 256 bits = 32 bytes = 64 hex digits (2 hex digits per byte)
-    if is_hex:
+    is_hex = all(c in string.hexdigits for c in name)
+    if is_hex and len(name) == 64:
+        # 256 bits = 32 bytes = 64 hex digits (2 hex digits per byte)
         return name
     
+    # name is the beginning of an OID, it has to match exactly one object
+    if is_hex and MIN_ABBREV <= len(name) < 64:
+        matches = data.find_objects(name)
+        assert len(matches) < 2, f'Ambiguous name {name}, could be {" or ".join(matches)}'
+        if matches:
+            return matches[0]
+    
     assert False, f'Unknown name {name}'
+
+MIN_ABBREV = 4 # shortest accepted abbreviated OID
     
 def is_ignored(path):
     return '.ugit' in path.split('/')
\ No newline at end of file
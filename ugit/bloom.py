@@ -0,0 +1,50 @@
+# Changed-path Bloom filters: for every commit, a small bit array that remembers which paths it changed
+# compared to its parent. Asking a filter "did this commit change <path>?" gives either
+#   "no"    -> certainly not, the commit (and its trees) doesn't need to be looked at
+#   "maybe" -> probably yes (about 1% of the time it's wrong), compare the trees to be sure
+# so 'ugit log -- <path>' can skip most commits without reading a single tree.
+#
+# Every path is set in NUM_HASHES bits, picked by hashing the path. A path is "maybe" in the filter
+# if all its bits are set. The leading directories of every changed file are added too,
+# so asking about a directory works as well ('dir/sub/file' changed -> 'dir' and 'dir/sub' changed).
+
+import hashlib
+
+BITS_PER_PATH = 10 # with 7 hashes that is ~1% false positives
+NUM_HASHES = 7
+MAX_CHANGED_PATHS = 512 # above this the filter would be big and the commit touches so much that we just say "maybe"
+
+TOO_MANY_PATHS = b'\xff' # all bits set: "maybe" for every path
+# and an empty filter (b'') means the commit changed nothing: "no" for every path
+
+def create(paths):
+    paths = with_parents(paths)
+    if len(paths) > MAX_CHANGED_PATHS:
+        return TOO_MANY_PATHS
+    bits = bytearray((len(paths) * BITS_PER_PATH + 7) // 8) # + 7 to round up to whole bytes
+    for path in paths:
+        for position in _positions(path, len(bits) * 8):
+            bits[position // 8] |= 1 << (position % 8)
+    return bytes(bits)
+
+def maybe_contains(bits, path):
+    if not bits:
+        return False
+    return all(bits[position // 8] & (1 << (position % 8)) for position in _positions(path, len(bits) * 8))
+
+# {'a/b/c.txt', 'd.txt'} -> {'a', 'a/b', 'a/b/c.txt', 'd.txt'}
+def with_parents(paths):
+    result = set()
+    for path in paths:
+        while path and path not in result:
+            result.add(path)
+            path = path.rpartition('/')[0]
+    return result
+
+# NUM_HASHES bit positions out of `size` for the path: two 64-bit hashes h1, h2 combined as h1 + i * h2
+# (double hashing, as good as NUM_HASHES independent hash functions but only one hash to compute)
+def _positions(path, size):
+    digest = hashlib.blake2b(path.encode(), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], 'big')
+    h2 = int.from_bytes(digest[8:], 'big') | 1 # odd, so the positions don't all land on the same few bits
+    return [(h1 + i * h2) % size for i in range(NUM_HASHES)]
@@ -3,13 +3,12 @@
 import argparse
 # Python built-in module for parsing command-line arguments.
 import os
-import subprocess
 import sys
-import textwrap
 
-from . import base
-from . import data
-from . import diff
+# Everything else (base, data, diff, watch, subprocess, textwrap...) is imported inside the commands that use it.
+# Python pays for every module it imports at startup, and most commands only need a few of them,
+# so 'ugit cat-file' doesn't have to load the watcher, the thread pool or difflib just to print an object.
+# See benchmarks/startup.py for how long starting ugit takes.
 
 def main():
     args = parse_args()
@@ -22,115 +21,271 @@ def main():
     #       file='example.txt',
     #       func=<function hash-object at 0x...>).
     
+    if args.trace or args.trace_file:
+        from . import trace
+        trace.enable(args.trace_file)
+        # see trace.py, a summary (or the trace file) is written when ugit exits
+    
     args.func(args)
     # And this should be equivalent to calling:
     #   hash_object(args)
+
+def oid(name):
+    from . import base
+    return base.get_oid(name)
+    # basically an alias of get_oid from base module,
+    # so we can pass it to argparse's 'type' for input validation/conversion
+    # (base is only imported once a command actually has an object name to look up)
+
+def parse_args(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    
+    paths = []
+    if '--' in argv:
+        # 'ugit log [oid] -- <path>...': everything after '--' is a path.
+        # Split it off by hand, argparse would give the first path to the optional oid argument
+        split = argv.index('--')
+        argv, paths = argv[:split], argv[split + 1:]
     
-def parse_args():
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(prog='ugit')
     # Create a new ArgumentParser object.
     
+    parser.add_argument('--trace', action='store_true') # print what the command did and how long each phase took
+    parser.add_argument('--trace-file') # write it as a Chrome trace (JSON) to this file instead
+    
     commands = parser.add_subparsers(dest='command', required=True)
     # Add subparsers for different commands (like 'init', 'commit',...)
     # the 'dest' argument specifies the attribute name for the command.
     # and make the command argument required.
     
-    oid = base.get_oid
-    # basically an alias: assign the get_oid function from base module to 'oid'
-    # so we can pass it to argparse's 'type' for input validation/conversion
-    
-    commands.add_parser('init').set_defaults(func=init)
-    # 'ugit init' command
-    
-    hash_object_parser = commands.add_parser('hash-object')
-    hash_object_parser.set_defaults(func=hash_object)
-    hash_object_parser.add_argument('file')
-    # 'ugit hash-object <file>' command
-    
-    cat_file_parser = commands.add_parser('cat-file')
-    cat_file_parser.set_defaults(func=cat_file)
-    cat_file_parser.add_argument('object', type=oid)
-    
-    write_tree_parser = commands.add_parser('write-tree')
-    write_tree_parser.set_defaults(func=write_tree)
-    
-    read_tree_parser = commands.add_parser('read-tree')
-    read_tree_parser.set_defaults(func=read_tree)
-    read_tree_parser.add_argument('tree', type=oid)
-    
-    commit_parser = commands.add_parser('commit')
-    commit_parser.set_defaults(func=commit)
-    commit_parser.add_argument('-m', '--message', required=True)
-    
-    log_parser = commands.add_parser('log')
-    log_parser.set_defaults(func=log)
-    log_parser.add_argument('oid', default='@', type=oid, nargs='?')
-    
-    checkout_parser = commands.add_parser('checkout')
-    checkout_parser.set_defaults(func=checkout)
-    checkout_parser.add_argument('commit')
-    
-    tag_parser = commands.add_parser('tag')
-    tag_parser.set_defaults(func=tag)
-    tag_parser.add_argument('name')
-    tag_parser.add_argument('oid', default='@', type=oid, nargs='?')
-    
-    k_parser = commands.add_parser('k')
-    k_parser.set_defaults(func=k)
-    # 'ugit k' command, similar to 'gitk', lists all refs
-    
-    branch_parser = commands.add_parser('branch')
-    branch_parser.set_defaults(func=branch)
-    branch_parser.add_argument('name', nargs='?')
-    branch_parser.add_argument('start_point', default='@', type=oid, nargs='?')
-    
-    status_parser = commands.add_parser('status')
-    status_parser.set_defaults(func=status)
-    
-    reset_parser = commands.add_parser('reset')
-    reset_parser.set_defaults(func=reset)
-    reset_parser.add_argument('commit', type=oid)
+    i = 0
+    while i < len(argv) and argv[i] in GLOBAL_OPTIONS:
+        i += GLOBAL_OPTIONS[argv[i]] # skip the options before the command name (and their values)
+    if i < len(argv) and argv[i] in COMMANDS:
+        # only the subparser of the command that is run is needed,
+        # setting up all the others would just slow down every ugit call
+        names = [argv[i]]
+    else:
+        names = COMMANDS # 'ugit --help', a typo, ... -> argparse needs all of them to print its message
     
-    show_parser = commands.add_parser('show')
-    show_parser.set_defaults(func=show)
-    show_parser.add_argument('oid', default='@', type=oid, nargs='?')
+    for name in names:
+        func, add_arguments = COMMANDS[name]
+        command_parser = commands.add_parser(name)
+        command_parser.set_defaults(func=func)
+        add_arguments(command_parser)
     
-    return parser.parse_args()
+    args = parser.parse_args(argv)
+    if paths and args.command not in PATH_COMMANDS:
+        parser.error(f"'ugit {args.command}' does not take paths")
+    args.paths = paths
+    return args
     # This should return Namespace(command='init', func=<function 'init' below>) for 'ugit init'
 
+# commands that accept '-- <path>...'
+PATH_COMMANDS = {'log'}
+
+# options that go before the command name -> how many arguments they take up (the option itself included)
+GLOBAL_OPTIONS = {'--trace': 1, '--trace-file': 2}
+
+GC_PRUNE_DEFAULT = 14 * 24 * 60 * 60 # two weeks, in seconds
+
+def _seconds(value):
+    return 0 if value == 'now' else int(value)
+
+def _count(value):
+    count = int(value)
+    if count < 0:
+        raise argparse.ArgumentTypeError(f'must be 0 or more, not {count}')
+    return count
+
+def _no_arguments(parser):
+    pass
+
+def _hash_object_arguments(parser):
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('file', nargs='?')
+    group.add_argument('--stdin-paths', action='store_true')
+    # 'ugit hash-object --stdin-paths' reads file paths from stdin (one per line) and prints their oids,
+    # small files are written in batches with data.hash_objects
+    # 'ugit hash-object <file>' command
+
+def _cat_file_arguments(parser):
+    # either an object or --batch, argparse reports it if there is neither (or both)
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('object', type=oid, nargs='?')
+    group.add_argument('--batch', action='store_true')
+    # 'ugit cat-file --batch' reads object names from stdin (one per line) and writes for each of them
+    #   <oid> <type> <size>\n<content>\n
+    # or '<name> missing\n', so scripts can read many objects with a single ugit process
+
+def _write_tree_arguments(parser):
+    parser.add_argument('-j', '--jobs', type=int, default=1) # number of threads hashing files
+
+def _read_tree_arguments(parser):
+    parser.add_argument('tree', type=oid)
+    parser.add_argument('-j', '--jobs', type=int, default=1) # number of threads writing files
+
+def _commit_arguments(parser):
+    parser.add_argument('-m', '--message', required=True)
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+
+def _log_arguments(parser):
+    parser.add_argument('oid', default='@', type=oid, nargs='?')
+    parser.add_argument('-n', '--max-count', type=_count) # stop after this many commits
+    # 'ugit log -- <path>...' only lists the commits that changed one of the paths
+
+def _checkout_arguments(parser):
+    parser.add_argument('commit')
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+
+def _tag_arguments(parser):
+    parser.add_argument('name')
+    parser.add_argument('oid', default='@', type=oid, nargs='?')
+
+def _branch_arguments(parser):
+    parser.add_argument('name', nargs='?')
+    parser.add_argument('start_point', default='@', type=oid, nargs='?')
+
+def _status_arguments(parser):
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1)
+
+def _reset_arguments(parser):
+    parser.add_argument('commit', type=oid)
+
+def _show_arguments(parser):
+    parser.add_argument('oid', default='@', type=oid, nargs='?')
+
+def _gc_arguments(parser):
+    parser.add_argument('--prune', type=_seconds, default=GC_PRUNE_DEFAULT)
+    # 'ugit gc' deletes the objects nothing refers to anymore once they are older than --prune seconds
+    # (two weeks by default, 'now' for all of them)
+    parser.add_argument('--compress', action='store_true')
+    # 'ugit gc --compress [--level N]' compresses all loose objects that are still stored raw
+    parser.add_argument('--level', type=int, default=-1) # -1 = zlib default level (6)
+
+def _fsck_arguments(parser):
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1) # number of processes checking objects
+
+def _repack_arguments(parser):
+    parser.add_argument('-a', '--all', action='store_true')
+    # 'ugit repack' moves loose objects into a new pack, with '-a' existing packs are merged in too
+    parser.add_argument('--window', type=int, default=10) # how many objects to try as delta bases (0 = no deltas)
+    parser.add_argument('--depth', type=int, default=50) # longest allowed delta chain
+
+def _watch_arguments(parser):
+    parser.add_argument('--stop', action='store_true')
+    # 'ugit watch' runs the filesystem watcher daemon in the foreground (use '&' to put it in the background),
+    # 'ugit watch --stop' stops it
+
 
 def init(args):
+    from . import base
+    from . import data
     base.init()
     print(f'Initialized ugit repository in {os.getcwd()}/{data.GIT_DIR}')
     
 def hash_object(args):
+    from . import data
+    if args.stdin_paths:
+        _hash_object_batch()
+        return
     with open (args.file, 'rb') as f: # 'rb' for reading binary files
-        print(data.hash_object(f.read()))
+        print(data.hash_file(f))
+
+HASH_BATCH_SIZE = 16 * 1024 * 1024 # bytes of small files collected before they are written together
+
+def _hash_object_batch():
+    from . import data
+    batch = [] # (content, 'blob') of small files not written yet
+    batch_size = 0
+    
+    def flush():
+        nonlocal batch_size
+        for oid in data.hash_objects(batch):
+            print(oid)
+        batch.clear()
+        batch_size = 0
+    
+    for line in sys.stdin:
+        path = line.rstrip('\n')
+        if not path:
+            continue
+        with open(path, 'rb') as f:
+            content = f.read(data.CHUNK_SIZE + 1)
+            if len(content) > data.CHUNK_SIZE:
+                # big file, streamed on its own by hash_file (after the batch so the oids stay in order)
+                flush()
+                f.seek(0)
+                print(data.hash_file(f))
+                continue
+        batch.append((content, 'blob'))
+        batch_size += len(content)
+        if batch_size >= HASH_BATCH_SIZE:
+            flush()
+    flush()
         
 def cat_file(args):
+    from . import data
+    if args.batch:
+        _cat_file_batch()
+        return
     sys.stdout.flush()
-    sys.stdout.buffer.write(data.get_object(args.object, expected='blob'))
+    data.copy_object(args.object, sys.stdout.buffer)
     
-    # Here we use sys.stdout.buffer to write binary data directly to stdout.
+    # Here we use sys.stdout.buffer to write binary data directly to stdout
+    # (copy_object streams it, big objects are even copied by the kernel without going through Python).
     # Before that, we flush stdout to ensure that any buffered output is written immediately.
     # For example, if before this line there was a print statement, it would be flushed before writing the binary data.
 
+def _cat_file_batch():
+    from . import base
+    from . import data
+    out = sys.stdout.buffer
+    
+    def oids():
+        for line in sys.stdin.buffer:
+            name = line.strip().decode()
+            if not name:
+                continue
+            data.forget_refs() # this process may run for a long time, refs could have moved since the last request
+            try:
+                yield base.get_oid(name)
+            except AssertionError:
+                yield name # unknown name, get_objects will report it as missing
+    
+    for oid, type_, content in data.get_objects(oids()):
+        if content is None:
+            out.write(f'{oid} missing\n'.encode())
+        else:
+            out.write(f'{oid} {type_} {len(content)}\n'.encode())
+            out.write(content)
+            out.write(b'\n')
+        out.flush() # the script on the other side might be waiting for this answer before asking the next one
+
 def write_tree(args):
-    print(base.write_tree())
+    from . import base
+    print(base.write_tree(jobs=args.jobs))
     
 def read_tree(args):
-    base.read_tree(args.tree)
+    from . import base
+    base.read_tree(args.tree, jobs=args.jobs)
     
 def commit(args):
-    print(base.commit(args.message))
+    from . import base
+    print(base.commit(args.message, jobs=args.jobs))
 
 def _print_commit(oid, commit, refs=None):
-    refs_str = f' ({", ".join(refs[oid])})' if refs else ''
+    import textwrap
+    refs_str = f' ({", ".join(refs)})' if refs else ''
     print(f'commit {oid}{refs_str}\n')
     print(textwrap.indent(commit.message, '    '))
     print('')
 
 def log(args):
+    import itertools
+    from . import base
+    from . import data
     refs = {}
     for refname, ref in data.iter_refs():
         refs.setdefault(ref.value, []).append(refname)
@@ -146,15 +301,20 @@ def log(args):
         #     "def456": ["refs/tags/v1.0"]
         # }
         
-    for oid in base.iter_commits_and_parents({args.oid}):
+    if args.paths:
+        oids = base.iter_commits_touching({args.oid}, args.paths)
+    else:
+        oids = base.iter_commits_and_parents({args.oid})
         # {args.oid} creates a set with a single element, args.oid
         # or else python would treat args.oid as a set of separated characters
+    
+    for oid in itertools.islice(oids, args.max_count): # islice(..., None) doesn't stop at all
         commit = base.get_commit(oid)
         _print_commit(oid, commit, refs.get(oid))
-        
-        oid = commit.parent
 
 def show(args):
+    from . import base
+    from . import diff
     if not args.oid:
         return
     commit = base.get_commit(args.oid)
@@ -163,19 +323,20 @@ def show(args):
         parent_tree = base.get_commit(commit.parent).tree
         
     _print_commit(args.oid, commit)
-    result = diff.diff_trees(
-        base.get_tree(parent_tree), base.get_tree(commit.tree)
-    )
     sys.stdout.flush()
-    sys.stdout.buffer.write(result)
+    for chunk in diff.diff_tree_oids(parent_tree, commit.tree):
+        sys.stdout.buffer.write(chunk)
     
 def checkout(args):
-    base.checkout(args.commit)
+    from . import base
+    base.checkout(args.commit, jobs=args.jobs)
 
 def tag(args):
+    from . import base
     base.create_tag(args.name, args.oid)
 
 def branch(args):
+    from . import base
     if not args.name:
         current = base.get_branch_name()
         for branch in base.iter_branch_name():
@@ -186,6 +347,8 @@ def branch(args):
         print(f'Branch {args.name} created at {args.start_point[:10]}')
     
 def k(args):
+    from . import base
+    from . import data
     dot = 'digraph commits {\n'
     
     oids = set()
@@ -196,20 +359,22 @@ def k(args):
             oids.add(ref.value)
     
     for oid in base.iter_commits_and_parents(oids):
-        commit = base.get_commit(oid)
+        parent = base.get_parent(oid)
         dot += f'"{oid}" [shape=box style=filled lable="{oid[:10]}"]\n'
-        if commit.parent:
-            dot += f'"{oid}" -> "{commit.parent}"\n'
+        if parent:
+            dot += f'"{oid}" -> "{parent}"\n'
         
     dot += '}'
     print(dot)
     
+    import subprocess
     with subprocess.Popen(
             ['dot', '-Tx11', '/dev/stdin'], # '-Tgtk' is not supported anymore
             stdin=subprocess.PIPE) as proc:
         proc.communicate(input=dot.encode())
         
 def status(args):
+    from . import base
     HEAD = base.get_oid('@')
     branch = base.get_branch_name()
     if branch:
@@ -217,5 +382,92 @@ def status(args):
     else:
         print(f'HEAD deached at {HEAD[:10]}')
     
+    modified, added, deleted = base.get_working_tree_changes(jobs=args.jobs)
+    if modified or added or deleted:
+        print('\nChanges:')
+        for label, paths in (('modified', modified), ('new file', added), ('deleted', deleted)):
+            for path in paths:
+                print(f'    {label}: {path}')
+    
 def reset(args):
-    base.reset(args.commit)
\ No newline at end of file
+    from . import base
+    base.reset(args.commit)
+
+def gc(args):
+    import time
+    from . import base
+    from . import data
+    pruned, dropped = base.gc(expire=time.time() - args.prune)
+    print(f'Removed {pruned} unreachable loose objects')
+    if dropped:
+        print(f'Removed {dropped} unreachable packed objects')
+    if args.compress:
+        count = data.compress_objects(args.level)
+        print(f'Compressed {count} objects')
+
+def fsck(args):
+    from . import base
+    problems = 0
+    for oid, problem in base.fsck(jobs=args.jobs):
+        print(f'{oid}: {problem}')
+        problems += 1
+    missing = []
+    base.mark_reachable(missing=missing)
+    for oid in missing:
+        print(f'missing {oid}')
+    if problems or missing:
+        sys.exit(1)
+
+def repack(args):
+    from . import data
+    count = data.repack(all_=args.all, window=args.window, depth=args.depth)
+    print(f'Packed {count} objects')
+
+def commit_graph(args):
+    from . import base
+    count = base.write_commit_graph()
+    print(f'Wrote commit-graph with {count} commits')
+
+def pack_refs(args):
+    from . import data
+    count = data.pack_refs()
+    print(f'Packed {count} refs')
+
+def migrate_objects(args):
+    from . import data
+    count = data.migrate_objects()
+    print(f'Moved {count} objects')
+
+def watch(args):
+    from . import watch as watcher
+    if args.stop:
+        if not watcher.stop():
+            print('ugit watch is not running')
+        return
+    watcher.run()
+
+# command name -> (function running it, function adding its arguments to the subparser)
+COMMANDS = {
+    'init': (init, _no_arguments),
+    'hash-object': (hash_object, _hash_object_arguments),
+    'cat-file': (cat_file, _cat_file_arguments),
+    'write-tree': (write_tree, _write_tree_arguments),
+    'read-tree': (read_tree, _read_tree_arguments),
+    'commit': (commit, _commit_arguments),
+    'log': (log, _log_arguments),
+    'checkout': (checkout, _checkout_arguments),
+    'tag': (tag, _tag_arguments),
+    'k': (k, _no_arguments), # similar to 'gitk', lists all refs
+    'branch': (branch, _branch_arguments),
+    'status': (status, _status_arguments),
+    'reset': (reset, _reset_arguments),
+    'show': (show, _show_arguments),
+    'gc': (gc, _gc_arguments),
+    'fsck': (fsck, _fsck_arguments),
+    'repack': (repack, _repack_arguments),
+    'commit-graph': (commit_graph, _no_arguments), # (re)writes .ugit/commit-graph for the whole history
+    'pack-refs': (pack_refs, _no_arguments), # moves branches and tags into .ugit/packed-refs
+    'migrate-objects': (migrate_objects, _no_arguments),
+    # moves objects from .ugit/objects/<oid> to .ugit/objects/<oid[:2]>/<oid[2:]>
+    'watch': (watch, _watch_arguments),
+}
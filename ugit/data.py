@@ -1,9 +1,21 @@
 # This file manages the data in .ugit directory. here will be the code that actually touches files on disk.add()
 
+import bisect
+import errno
+import functools
 import hashlib
+import io
+import itertools
+import mmap
 import os
+import struct
+import threading
+import zlib
 
-from collections import namedtuple
+from collections import deque, namedtuple, OrderedDict
+
+from . import delta
+from . import trace
 
 GIT_DIR = '.ugit'
 
@@ -18,6 +30,7 @@ def init():
 RefValue = namedtuple('RefValue', ['symbolic','value'])
         
 def update_ref(ref, value, deref=True):
+    global ref_epoch
     ref = _get_ref_internal(ref, deref)[0]
     
     assert value.value
@@ -31,6 +44,9 @@ def update_ref(ref, value, deref=True):
     # exits_ok=True will not raise an error if the directory already exists
     with open(ref_path, 'w') as f:
         f.write(value)
+    # a loose ref always wins over packed-refs, so the new value is all we need to remember
+    _ref_cache[ref] = value
+    ref_epoch += 1
     
 def get_ref(ref, deref=True): # ref here is expected to be a relative path from GIT_DIR
     return _get_ref_internal(ref, deref)[1]
@@ -40,12 +56,7 @@ def get_ref(ref, deref=True): # ref here is expected to be a relative path from
 # non-symbolic ref -> return the ref name and value
 # symbolic ref -> dereference recursively and return the last non-symbolic ref
 def _get_ref_internal(ref, deref):    
-    ref_path = os.path.join(GIT_DIR, ref)
-    value = None
-    if os.path.isfile(ref_path):
-        # Check if the ref file exists first, we don't want to create a file if it doesn't exist
-        with open(ref_path, 'r') as f:
-            value = f.read().strip() # strip to remove any trailing newline or spaces
+    value = _read_ref(ref)
     
     symbolic = bool(value) and value.startswith('ref:')
     if symbolic:
@@ -55,6 +66,66 @@ def _get_ref_internal(ref, deref):
             return _get_ref_internal(value, deref=True)
     
     return ref, RefValue(symbolic=symbolic, value=value)
+
+# Every ref is read from disk at most once per process: _ref_cache remembers the raw value
+# (or None if the ref doesn't exist) and update_ref keeps it up to date.
+# ref_epoch changes whenever a ref is updated, so caches built on top of refs (like base.get_oid) know when to drop their values
+_ref_cache = {}
+ref_epoch = 0
+
+def _read_ref(ref):
+    trace.count('ref_lookups')
+    if ref in _ref_cache:
+        trace.count('ref_cache_hits')
+        return _ref_cache[ref]
+    try:
+        with open(os.path.join(GIT_DIR, ref), 'r') as f:
+            value = f.read().strip() # strip to remove any trailing newline or spaces
+    except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+        # no loose ref file, maybe it was moved to packed-refs
+        value = _load_packed_refs().get(ref)
+    _ref_cache[ref] = value
+    return value
+
+# Forget every ref read so far, the next lookups read them from disk again.
+# For long-running processes ('ugit cat-file --batch'), other processes may update refs in the meantime
+def forget_refs():
+    global ref_epoch
+    _ref_cache.clear()
+    _load_packed_refs.cache_clear()
+    ref_epoch += 1 # drops base.get_oid's cache too
+
+# .ugit/packed-refs stores many refs in one file, one '<oid> <refname>' per line,
+# so repositories with thousands of tags don't need thousands of tiny files.
+# A loose ref file with the same name overrides the packed value
+@functools.lru_cache(maxsize=None)
+def _load_packed_refs():
+    refs = {}
+    try:
+        with open(os.path.join(GIT_DIR, 'packed-refs'), 'r') as f:
+            for line in f:
+                value, refname = line.rstrip('\n').split(' ', 1)
+                refs[refname] = value
+    except FileNotFoundError:
+        pass
+    return refs
+
+# move all (non-symbolic) refs under refs/ into packed-refs, returns how many were packed
+def pack_refs():
+    refs = {refname: ref.value for refname, ref in iter_refs('refs/', deref=False)
+            if not ref.symbolic and ref.value}
+    packed_path = os.path.join(GIT_DIR, 'packed-refs')
+    with open(packed_path + '.lock', 'w') as f:
+        f.write(''.join(f'{value} {refname}\n' for refname, value in sorted(refs.items())))
+    os.replace(packed_path + '.lock', packed_path)
+    
+    for refname in refs:
+        try:
+            os.remove(os.path.join(GIT_DIR, refname))
+        except FileNotFoundError:
+            pass # was only packed already
+    _load_packed_refs.cache_clear()
+    return len(refs)
     
 def iter_refs(prefix='', deref=True):
     refs = ['HEAD']
@@ -75,29 +146,1105 @@ def iter_refs(prefix='', deref=True):
         
         refs.extend(os.path.join(root, f) for f in filenames)
         # += 'refs/tags/filename' for each file in the 'refs/tags' directory
+    
+    loose = set(refs)
+    refs.extend(refname for refname in _load_packed_refs() if refname not in loose)
         
     for refname in refs:
         if not refname.startswith(prefix):
             continue
         yield refname, get_ref(refname, deref=deref)
         
+CHUNK_SIZE = 1024 * 1024 # 1 MiB, hash_file never holds more than this much of a file in memory
+
+# zlib level (1-9, -1 for zlib's default) used for new loose objects, 0 stores them uncompressed.
+# For example: UGIT_COMPRESSION=6 ugit commit -m "..."
+COMPRESSION_LEVEL = int(os.environ.get('UGIT_COMPRESSION', '0'))
+
+# Loose objects are spread over 256 subdirectories named after the first two hex digits of their oid:
+# .ugit/objects/ab/cdef... so no directory ends up with millions of entries.
+# Older repositories keep all of them directly in .ugit/objects/<oid>, that layout is still read
+# (see _flat_object_path) until 'ugit migrate-objects' moves them
+def _object_path(oid):
+    return os.path.join(GIT_DIR, 'objects', oid[:2], oid[2:])
+
+def _flat_object_path(oid):
+    return os.path.join(GIT_DIR, 'objects', oid)
+
+# path of the loose object file for oid in whichever layout it is stored, None if there is none
+def _find_loose(oid):
+    for path in (_object_path(oid), _flat_object_path(oid)):
+        if os.path.exists(path):
+            return path
+    return None
+
+# Objects are first written to a temp file inside .ugit/objects and then renamed to their oid,
+# rename is atomic so readers never see a half written object (e.g. after a crash or Ctrl-C)
+def _open_temp_object():
+    import tempfile # pulls in shutil and random, only worth it for commands that write objects
+    fd, tmp_path = tempfile.mkstemp(prefix='tmp_obj_', dir=os.path.join(GIT_DIR, 'objects'))
+    return os.fdopen(fd, 'wb'), tmp_path
+
+# write 'type\0' followed by the chunks, zlib-compressed if level is not 0
+def _write_object(out, type_, chunks, level=None):
+    if level is None:
+        level = COMPRESSION_LEVEL
+    compressor = zlib.compressobj(level) if level else None
+    for chunk in itertools.chain([type_.encode() + b'\x00'], chunks):
+        # write the header and the data separately instead of concatenating them,
+        # which would make a second copy of data in memory
+        out.write(compressor.compress(chunk) if compressor else chunk)
+    if compressor:
+        out.write(compressor.flush())
+
+def _finish_temp_object(tmp_path, oid):
+    if object_exists(oid) and _freshen_object(oid):
+        os.remove(tmp_path)
+        stats['writes_skipped'] += 1
+        return
+    path = _object_path(oid)
+    directory = os.path.dirname(path)
+    if directory not in _object_dirs:
+        os.makedirs(directory, exist_ok=True)
+        _object_dirs.add(directory)
+    os.replace(tmp_path, path)
+    _known_oids.add(oid)
+    _freshened.add(oid) # just written, its mtime is now
+    stats['objects_written'] += 1
+
+# Objects are content-addressed: if a file named <oid> exists it already has the right content,
+# so it never needs to be written again. _known_oids remembers the oids we have already seen
+# in this process so we don't even need to ask the filesystem twice
+_known_oids = set()
+_object_dirs = set() # fan-out directories we know exist, no need to call makedirs for them again
+stats = {'objects_written': 0, 'writes_skipped': 0}
+
+def object_exists(oid):
+    if oid in _known_oids:
+        return True
+    if _find_loose(oid) or _find_packed(oid):
+        _known_oids.add(oid)
+        return True
+    return False
+
+# A write is skipped when the object exists already, but gc deletes unreachable objects by their mtime
+# (see base.gc): an old unreachable object that the commit being made right now reuses could be
+# deleted before the commit points to it. So a skipped write touches the loose file, or the pack
+# holding the object, to make it as new as a written one (git "freshens" objects the same way).
+# Returns False if the object vanished in the meantime, the caller writes it again then
+_freshened = set() # once per oid and process is enough
+def _freshen_object(oid):
+    if oid in _freshened:
+        return True
+    path = _find_loose(oid)
+    if not path:
+        found = _find_packed(oid)
+        path = found and os.path.join(_pack_dir(), found[0].name + '.pack')
+    try:
+        os.utime(path)
+    except (FileNotFoundError, TypeError): # TypeError: path is None, not stored anywhere
+        _known_oids.discard(oid)
+        return False
+    _freshened.add(oid)
+    return True
+
 def hash_object(data, type_='blob'): # data should be in bytes (e.g. b'hello world' -> binary)
     # type_ is the type of object, default is 'blob', the underscore is to avoid conflict or confusion with the built-in type
     # also to declare that it should be followed by a null byte
-    obj = type_.encode() + b'\x00' + data
-    # encode the type from string to bytes, add a null byte, and concatenate with data
     oid = hashlib.sha256(data).hexdigest() # dont forget to digest the sha256 HASH object
-    with open(os.path.join(GIT_DIR, 'objects', oid), 'wb') as out: # 'wb' for binary write
-        out.write(obj)
+    trace.count('bytes_hashed', len(data))
+    if object_exists(oid) and _freshen_object(oid):
+        stats['writes_skipped'] += 1
+        return oid
+    out, tmp_path = _open_temp_object()
+    try:
+        with out:
+            _write_object(out, type_, [data])
+        _finish_temp_object(tmp_path, oid)
+    except BaseException:
+        os.remove(tmp_path) # don't leave the temp file behind
+        raise
     return oid
 
-def get_object(oid, expected='blob'):
-    with open (os.path.join(GIT_DIR, 'objects', oid), 'rb') as f: # 'rb' for binary read
+# Same as hash_object, but reads the content from a binary file object in CHUNK_SIZE pieces,
+# so memory usage stays the same no matter how big the file is.
+# The oid is only known at the end, so if the object turns out to exist already the temp file is dropped
+def hash_file(f, type_='blob'):
+    h = hashlib.sha256()
+    
+    def chunks():
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            # iter(callable, sentinel) keeps calling f.read() until it returns b'' (end of file)
+            h.update(chunk)
+            trace.count('bytes_hashed', len(chunk))
+            yield chunk
+    
+    out, tmp_path = _open_temp_object()
+    try:
+        with out:
+            _write_object(out, type_, chunks())
+        oid = h.hexdigest()
+        _finish_temp_object(tmp_path, oid)
+    except BaseException:
+        os.remove(tmp_path) # don't leave the temp file behind
+        raise
+    return oid
+
+# objects: iterable of (data, type_), returns the list of their oids.
+# Same as hash_object for each of them, but what doesn't depend on the object is done once per batch:
+# one existence check per distinct oid, the fan-out directories are created up front
+# and all objects are written through the same temp file path instead of a new mkstemp each
+def hash_objects(objects):
+    objects = list(objects)
+    oids = []
+    for data, _ in objects:
+        oids.append(hashlib.sha256(data).hexdigest())
+        trace.count('bytes_hashed', len(data))
+    
+    to_write = {}
+    for oid, (data, type_) in zip(oids, objects):
+        if oid in to_write:
+            continue # twice in the same batch
+        if object_exists(oid) and _freshen_object(oid):
+            stats['writes_skipped'] += 1
+            continue
+        to_write[oid] = (data, type_)
+    if not to_write:
+        return oids
+    
+    for directory in {os.path.dirname(_object_path(oid)) for oid in to_write}:
+        if directory not in _object_dirs:
+            os.makedirs(directory, exist_ok=True)
+            _object_dirs.add(directory)
+    out, tmp_path = _open_temp_object()
+    out.close()
+    os.remove(tmp_path) # only the (unique) name is needed, each object creates the file again
+    try:
+        for oid, (data, type_) in to_write.items():
+            with open(tmp_path, 'xb') as out: # 'x': fail instead of overwriting if someone took the name
+                _write_object(out, type_, [data])
+            os.replace(tmp_path, _object_path(oid))
+            _known_oids.add(oid)
+            _freshened.add(oid)
+            stats['objects_written'] += 1
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path) # don't leave the temp file behind
+        raise
+    return oids
+
+# Compressed objects are recognised by their first byte: a zlib stream starts with 0x78 ('x')
+# while an uncompressed object starts with its type ('blob', 'tree', 'commit'),
+# so old uncompressed objects and new compressed ones can live side by side
+def _is_compressed(obj):
+    return obj[:1] == b'x'
+
+# zlib.decompress, but a damaged object raises ValueError like the other kinds of corruption,
+# so callers (fsck, gc, ...) only have one error to deal with
+def _decompress(data):
+    try:
+        return zlib.decompress(data)
+    except zlib.error as e:
+        raise ValueError(f'corrupt zlib data ({e})')
+
+# Find where an object is stored, for _read_object and open_object.
+# Returns ((pack, offset), None) for a packed object and (None, open loose object file) otherwise,
+# raises FileNotFoundError if there is no such object
+def _locate_object(oid):
+    trace.count('object_reads')
+    found = _find_packed(oid)
+    if not found:
+        # not packed, fall back to the loose object
+        try:
+            return None, _open_loose(oid)
+        except FileNotFoundError:
+            # maybe another ugit process repacked it in the meantime, look at the packs once more
+            found = _reload_packs() and _find_packed(oid)
+            if not found:
+                raise
+    trace.count('packed_object_reads')
+    return found, None
+
+# returns the whole 'type\0content' of an object
+def _read_object(oid):
+    found, f = _locate_object(oid)
+    if found:
+        return _read_packed(*found)
+    with f:
         obj = f.read()
+    trace.count('loose_bytes_read', len(obj))
+    if _is_compressed(obj):
+        obj = _decompress(obj)
+    return obj
+
+def _read_loose(oid):
+    with _open_loose(oid) as f:
+        return f.read()
+
+def _open_loose(oid):
+    try:
+        return open (_object_path(oid), 'rb') # 'rb' for binary read
+    except FileNotFoundError:
+        return open (_flat_object_path(oid), 'rb') # not migrated to the fan-out layout yet
+
+# the oid hash_file would give, without writing anything to the object store
+def hash_file_oid(f):
+    h = hashlib.sha256()
+    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+        h.update(chunk)
+        trace.count('bytes_hashed', len(chunk))
+    return h.hexdigest()
+
+def get_object(oid, expected='blob'):
+    obj = _read_object(oid)
     type_, _, content = obj.partition(b'\x00')
     # partition(<separator>) splits the bytes object into three parts: before the sep, the separator it self, and after the sep
     type_=type_.decode() # decode the type from bytes back to string
     
     # if expected != type_:
     #     raise ValueError(f"Expected object type '{expected}', but got '{type_}'")
-    return content
\ No newline at end of file
+    return content
+
+# Open an object to read its content piece by piece instead of loading all of it like get_object does.
+# Returns (type_, f), f is a binary file object positioned at the start of the content:
+#   - uncompressed loose object: the object file itself (so copy_object can hand it to the kernel)
+#   - compressed loose object or whole object in a pack: decompressed on the fly, CHUNK_SIZE at a time
+#   - delta in a pack: the result has to be built in memory anyway, f reads from that
+def open_object(oid):
+    found, f = _locate_object(oid)
+    if found:
+        pack, offset = found
+        kind, length = _PACK_ENTRY.unpack_from(pack.data, offset)
+        start = offset + _PACK_ENTRY.size
+        if kind == PACK_FULL:
+            # a memoryview slices the mapped pack without copying it
+            view = memoryview(pack.data)[start:start + length]
+            chunks = (view[i:i + CHUNK_SIZE] for i in range(0, length, CHUNK_SIZE))
+            f = io.BufferedReader(_ZlibReader(lambda: next(chunks, b'')))
+        else:
+            f = io.BufferedReader(io.BytesIO(_read_packed(pack, offset)))
+    elif _is_compressed(f.peek(1)):
+        loose = f
+        f = io.BufferedReader(_ZlibReader(lambda: loose.read(CHUNK_SIZE), loose.close))
+    
+    header = f.peek(64)[:64] # 'type\0' is much shorter than that
+    if b'\x00' not in header:
+        f.close()
+        assert False, f'Object {oid} has no header'
+    type_ = header[:header.index(b'\x00')]
+    f.read(len(type_) + 1)
+    return type_.decode(), f
+
+# A read-only file object decompressing a zlib stream, read_compressed() returns the next
+# piece of compressed data (b'' at the end)
+class _ZlibReader(io.RawIOBase):
+    def __init__(self, read_compressed, close=None):
+        self._read_compressed = read_compressed
+        self._close = close
+        self._decompressor = zlib.decompressobj()
+    
+    def readable(self):
+        return True
+    
+    def readinto(self, buf):
+        while not self._decompressor.eof:
+            # input decompress() couldn't use yet (because buf was full) comes first
+            compressed = self._decompressor.unconsumed_tail or self._read_compressed()
+            if not compressed:
+                raise ValueError('corrupt zlib data (truncated object)')
+            try:
+                out = self._decompressor.decompress(compressed, len(buf))
+            except zlib.error as e:
+                raise ValueError(f'corrupt zlib data ({e})') # same error as _decompress
+            if out:
+                buf[:len(out)] = out
+                return len(out)
+        return 0 # end of the stream
+    
+    def close(self):
+        if self._close:
+            self._close()
+        super().close()
+
+ZERO_COPY_MIN_SIZE = 64 * 1024 # below this a plain read and write is cheaper than setting up the kernel copy
+
+# Write the content of an object to the binary file object out and return the number of bytes written.
+# If the object is an uncompressed loose object and out is a real file (or pipe, socket...),
+# the kernel copies the data straight from the object file with copy_file_range or sendfile,
+# it never passes through Python, so memory use is the same for a 1 KB and a 4 GB blob.
+# Otherwise it's copied CHUNK_SIZE at a time
+def copy_object(oid, out):
+    _, f = open_object(oid)
+    with f:
+        try:
+            in_fd, out_fd = f.fileno(), out.fileno()
+        except (OSError, ValueError): # io.UnsupportedOperation: decompressed on the fly, or out isn't a file
+            in_fd = out_fd = None
+        if in_fd is not None:
+            offset = f.tell()
+            size = os.fstat(in_fd).st_size - offset
+            if size >= ZERO_COPY_MIN_SIZE:
+                out.flush() # whatever was written to out before has to come first
+                copied = _copy_fd_range(in_fd, out_fd, offset, size)
+                trace.count('zero_copy_bytes', copied)
+                if copied == size:
+                    return size
+                f.seek(offset + copied) # the kernel couldn't do it (all), copy the rest ourselves
+                return copied + _copy_chunks(f, out)
+        return _copy_chunks(f, out)
+
+def _copy_chunks(f, out):
+    copied = 0
+    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+        out.write(chunk)
+        copied += len(chunk)
+    return copied
+
+# errors meaning "this kind of copy isn't possible here" (old kernel, different filesystems,
+# out is a pipe for copy_file_range...), the next way of copying is tried then
+_COPY_UNSUPPORTED = {errno.EINVAL, errno.ENOSYS, errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF}
+
+# copy size bytes at offset of in_fd to out_fd inside the kernel, returns how many bytes it managed to copy
+def _copy_fd_range(in_fd, out_fd, offset, size):
+    copied = 0
+    copy_functions = []
+    if hasattr(os, 'copy_file_range'): # Linux only, can even share the blocks on filesystems that support it
+        copy_functions.append(lambda offset, count: os.copy_file_range(in_fd, out_fd, count, offset_src=offset))
+    if hasattr(os, 'sendfile'):
+        copy_functions.append(lambda offset, count: os.sendfile(out_fd, in_fd, offset, count))
+    for copy in copy_functions:
+        try:
+            while copied < size:
+                n = copy(offset + copied, size - copied)
+                if n == 0:
+                    return copied # the object file is shorter than it was a moment ago
+                copied += n
+            return copied
+        except OSError as e:
+            if e.errno not in _COPY_UNSUPPORTED:
+                raise
+    return copied
+
+# Batch version of get_object, for callers with many objects to read at once ('ugit cat-file --batch',
+# hash_objects above is the one for writing). get_objects yields (oid, type_, content) for each oid, type_ and content are None if there is no such object
+def get_objects(oids):
+    for oid in oids:
+        try:
+            if len(oid) != 64:
+                raise ValueError(f'Not an oid: {oid}')
+            obj = _read_object(oid)
+        except (FileNotFoundError, ValueError): # ValueError: not even a valid oid
+            yield oid, None, None
+            continue
+        type_, _, content = obj.partition(b'\x00')
+        yield oid, type_.decode(), content
+
+# Read one stored copy of an object, the loose one (packed=False) or the one in a pack (packed=True),
+# and check that its content still hashes to its oid. Returns (type_, content), raises ValueError if it's damaged
+def verify_object(oid, packed):
+    if packed:
+        obj = _read_packed(*_find_packed(oid))
+    else:
+        obj = _read_loose(oid)
+        if _is_compressed(obj):
+            obj = _decompress(obj)
+    type_, separator, content = obj.partition(b'\x00')
+    if not separator:
+        raise ValueError('no object header')
+    if hashlib.sha256(content).hexdigest() != oid:
+        raise ValueError('content does not match the oid')
+    return type_.decode(errors='replace'), content
+
+def iter_loose_objects():
+    for oid, _ in _iter_loose_paths():
+        yield oid
+
+# yields (oid, path of the object file) for all loose objects, in both layouts
+def _iter_loose_paths():
+    objects_dir = os.path.join(GIT_DIR, 'objects')
+    with os.scandir(objects_dir) as it:
+        for entry in it:
+            if len(entry.name) == 64 and entry.is_file():
+                yield entry.name, entry.path # old flat layout
+            elif _is_shard(entry.name) and entry.is_dir():
+                for name in os.listdir(entry.path):
+                    if len(name) == 62: # skip anything that isn't an object
+                        yield entry.name + name, os.path.join(entry.path, name)
+
+def _is_shard(name):
+    return len(name) == 2 and all(c in '0123456789abcdef' for c in name)
+
+# move objects from the old flat layout to the fan-out layout, returns how many were moved
+def migrate_objects():
+    count = 0
+    for oid, path in list(_iter_loose_paths()):
+        if path != _flat_object_path(oid):
+            continue
+        os.makedirs(os.path.dirname(_object_path(oid)), exist_ok=True)
+        os.replace(path, _object_path(oid)) # a rename on the same filesystem, the content isn't copied
+        count += 1
+    _flat_loose_objects.cache_clear()
+    return count
+
+# Delete the loose objects is_reachable(oid) says no to, as long as they are older than `expire` (a time.time() value).
+# Younger ones are kept: another ugit process might have just written them for a commit it hasn't finished yet.
+# Temp files left behind by interrupted writes are removed the same way. Returns how many objects were deleted
+def prune_loose_objects(is_reachable, expire):
+    count = 0
+    for oid, path in _iter_loose_paths():
+        if is_reachable(oid) or os.lstat(path).st_mtime >= expire:
+            continue
+        os.remove(path)
+        _known_oids.discard(oid)
+        count += 1
+    for entry in os.scandir(os.path.join(GIT_DIR, 'objects')):
+        if entry.name.startswith('tmp_obj_') and entry.stat().st_mtime < expire:
+            os.remove(entry.path)
+    _sorted_loose_objects.cache_clear()
+    _flat_loose_objects.cache_clear()
+    return count
+
+# oids of the objects in packs written before `expire`
+def iter_old_packed_objects(expire):
+    for pack in _load_packs():
+        if os.path.getmtime(os.path.join(_pack_dir(), pack.name + '.pack')) < expire:
+            yield from _iter_pack_oids(pack)
+
+# rewrite every uncompressed loose object compressed with the given level, returns how many were rewritten
+@trace.timed('compress_objects')
+def compress_objects(level=zlib.Z_DEFAULT_COMPRESSION):
+    count = 0
+    for oid, path in _iter_loose_paths():
+        with open(path, 'rb') as f:
+            obj = f.read()
+        if _is_compressed(obj):
+            continue
+        type_, _, content = obj.partition(b'\x00')
+        out, tmp_path = _open_temp_object()
+        with out:
+            _write_object(out, type_.decode(), [content], level)
+        os.replace(tmp_path, path) # same oid, so replace the old file in place
+        count += 1
+    return count
+
+# Packs bundle many objects into one file, .ugit/objects/pack/pack-<name>.pack:
+#   <header: 'UPCK', version, object count>
+#   <entry>...<entry>, each entry is <kind (1 byte)><length (8 bytes)><data>
+#       PACK_FULL entry:  data = <zlib-compressed 'type\0content'>
+#       PACK_DELTA entry: data = <oid of the base object (32 raw bytes)><zlib-compressed delta.create_delta(base, object)>
+# and next to it an index, pack-<name>.idx, used to find an entry without reading the pack:
+#   <header: 'UPIX', version, object count>
+#   <fan-out table: 256 counts, fanout[b] = number of oids whose first byte is <= b>
+#   <all oids, sorted, 32 raw bytes each>
+#   <offset of each object in the pack, in the same order as the oids>
+# Both files are mmap-ed, the fan-out table narrows the search to the oids starting with the
+# same byte and a binary search over the sorted oids does the rest.
+PACK_SIGNATURE = b'UPCK'
+PACK_IDX_SIGNATURE = b'UPIX'
+PACK_VERSION = 2
+_PACK_HEADER = struct.Struct('>4sII') # signature, version, number of objects
+_PACK_ENTRY = struct.Struct('>BQ') # kind, length of the data that follows
+_PACK_FANOUT = struct.Struct('>256I')
+_PACK_OFFSET = struct.Struct('>Q')
+PACK_FULL = 0 # entry kind: a whole object
+PACK_DELTA = 1 # entry kind: a delta against another object of the same pack
+
+Pack = namedtuple('Pack', ['name', 'idx', 'data', 'count', 'fanout'])
+
+def _pack_dir():
+    return os.path.join(GIT_DIR, 'objects', 'pack')
+
+# modification time of the pack directory, None if there is none
+def _pack_dir_mtime():
+    try:
+        return os.stat(_pack_dir()).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+_loaded_packs_mtime = None # _pack_dir_mtime() when _load_packs last read the directory
+
+@functools.lru_cache(maxsize=None)
+def _load_packs():
+    global _loaded_packs_mtime
+    _loaded_packs_mtime = _pack_dir_mtime()
+    packs = []
+    if not os.path.isdir(_pack_dir()):
+        return packs
+    for filename in sorted(os.listdir(_pack_dir())):
+        if not filename.endswith('.idx'):
+            continue
+        name = filename[:-len('.idx')]
+        with open(os.path.join(_pack_dir(), filename), 'rb') as f:
+            idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(os.path.join(_pack_dir(), name + '.pack'), 'rb') as f:
+            pack_data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # the file can be closed, the mapping stays valid
+        
+        signature, version, count = _PACK_HEADER.unpack_from(idx)
+        assert signature == PACK_IDX_SIGNATURE and version == PACK_VERSION, f'Bad pack index {filename}'
+        fanout = _PACK_FANOUT.unpack_from(idx, _PACK_HEADER.size)
+        packs.append(Pack(name, idx, pack_data, count, fanout))
+    return packs
+
+# Binary search for a raw oid in a table of sorted 32-byte oids starting at `start` in buf,
+# fanout[b] is the number of oids whose first byte is <= b (so only that part of the table is searched).
+# Returns the position of the oid in the table or None
+def _bisect_oid(buf, start, fanout, raw):
+    i = _bisect_oid_left(buf, start, fanout, raw)
+    if i < fanout[raw[0]] and buf[start + i * 32:start + i * 32 + 32] == raw:
+        return i
+    return None
+
+# position of the first oid in the table that is >= raw
+def _bisect_oid_left(buf, start, fanout, raw):
+    lo = fanout[raw[0] - 1] if raw[0] else 0
+    hi = fanout[raw[0]]
+    while lo < hi:
+        mid = (lo + hi) // 2
+        pos = start + mid * 32
+        if buf[pos:pos + 32] < raw:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+def _build_fanout(oids): # oids: sorted hex oids
+    fanout = [0] * 256
+    for oid in oids:
+        fanout[int(oid[:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1] # turn the counts into running totals
+    return fanout
+
+# Load the packs again if another process wrote or removed one since they were loaded
+# (adding or removing a file changes the directory's mtime), returns True if it did.
+# An object that isn't anywhere doesn't cost a reload this way, only a stat
+def _reload_packs():
+    if _pack_dir_mtime() == _loaded_packs_mtime:
+        return False
+    _load_packs.cache_clear()
+    return True
+
+# returns (pack, offset of the object in the pack) or None if the oid is in no pack
+def _find_packed(oid):
+    raw = bytes.fromhex(oid)
+    for pack in _load_packs():
+        oids_start = _PACK_HEADER.size + _PACK_FANOUT.size
+        i = _bisect_oid(pack.idx, oids_start, pack.fanout, raw)
+        if i is not None:
+            offsets_start = oids_start + pack.count * 32
+            offset, = _PACK_OFFSET.unpack_from(pack.idx, offsets_start + i * _PACK_OFFSET.size)
+            return pack, offset
+    return None
+
+def _read_packed(pack, offset):
+    kind, length = _PACK_ENTRY.unpack_from(pack.data, offset)
+    start = offset + _PACK_ENTRY.size
+    if kind == PACK_FULL:
+        return _decompress(pack.data[start:start + length])
+    assert kind == PACK_DELTA, f'Unknown pack entry kind {kind} in {pack.name}'
+    base = _read_delta_base(pack.data[start:start + 32].hex())
+    return delta.apply_delta(base, _decompress(pack.data[start + 32:start + length]))
+
+# Objects that are bases of deltas are usually needed again soon (by the other deltas against them),
+# so keep the most recently used ones around, up to DELTA_BASE_CACHE_SIZE bytes in total
+DELTA_BASE_CACHE_SIZE = 64 * 1024 * 1024
+_delta_base_cache = OrderedDict()
+_delta_base_cache_bytes = 0
+_delta_base_cache_lock = threading.Lock() # objects can be read from several threads (e.g. read_tree with jobs)
+
+def _read_delta_base(oid):
+    global _delta_base_cache_bytes
+    with _delta_base_cache_lock:
+        if oid in _delta_base_cache:
+            _delta_base_cache.move_to_end(oid) # mark as most recently used
+            trace.count('delta_base_cache_hits')
+            return _delta_base_cache[oid]
+    
+    trace.count('delta_base_cache_misses')
+    obj = _read_object(oid) # the base might be a delta itself, this recurses down the chain
+    with _delta_base_cache_lock:
+        if oid not in _delta_base_cache:
+            _delta_base_cache[oid] = obj
+            _delta_base_cache_bytes += len(obj)
+        while _delta_base_cache_bytes > DELTA_BASE_CACHE_SIZE and len(_delta_base_cache) > 1:
+            _, evicted = _delta_base_cache.popitem(last=False) # drop the least recently used
+            _delta_base_cache_bytes -= len(evicted)
+    return obj
+
+def iter_packed_objects():
+    for pack in _load_packs():
+        yield from _iter_pack_oids(pack)
+
+# (oid, offset of its entry in the pack file) of every object in the pack
+def _iter_pack_offsets(pack):
+    offsets_start = _PACK_HEADER.size + _PACK_FANOUT.size + pack.count * 32
+    for i, oid in enumerate(_iter_pack_oids(pack)):
+        offset, = _PACK_OFFSET.unpack_from(pack.idx, offsets_start + i * _PACK_OFFSET.size)
+        yield oid, offset
+
+def _iter_pack_oids(pack):
+    oids_start = _PACK_HEADER.size + _PACK_FANOUT.size
+    for i in range(pack.count):
+        pos = oids_start + i * 32
+        yield pack.idx[pos:pos + 32].hex()
+
+# size of an object as stored on disk, good enough to sort objects by size before delta compressing them
+def _stored_size(oid):
+    found = _find_packed(oid)
+    if found:
+        pack, offset = found
+        return _PACK_ENTRY.unpack_from(pack.data, offset)[1]
+    return os.path.getsize(_find_loose(oid))
+
+DELTA_MAX_SIZE = 16 * 1024 * 1024 # bigger objects are always stored whole, finding a delta would be too slow
+
+# Move objects into a new pack. By default only loose objects are packed,
+# with all_=True the existing packs are merged into the new one as well.
+# Objects are stored as deltas against one of the last `window` objects of the same type
+# when that is smaller, a delta chain never gets longer than `depth` so reads stay fast.
+# Returns the number of objects in the new pack.
+@trace.timed('repack')
+def repack(all_=False, window=10, depth=50):
+    loose = dict(_iter_loose_paths())
+    oids = set(loose)
+    old_packs = _load_packs() if all_ else []
+    for pack in old_packs:
+        oids.update(_iter_pack_oids(pack))
+    if not oids:
+        return 0
+    level = COMPRESSION_LEVEL or zlib.Z_DEFAULT_COMPRESSION
+    
+    def entries():
+        candidates = deque(maxlen=window) # (oid, object, delta chain depth) of the last objects written
+        # similar objects (e.g. two versions of a file) usually have similar sizes,
+        # going from the biggest to the smallest puts them next to each other in the window
+        for oid in sorted(oids, key=_stored_size, reverse=True):
+            type_, f = open_object(oid)
+            content = f.read(DELTA_MAX_SIZE + 1)
+            if len(content) > DELTA_MAX_SIZE:
+                # no delta for this one, compress it while it's copied into the pack instead of loading it all
+                yield oid, PACK_FULL, _compress_object(type_, content, f, level)
+                continue
+            f.close()
+            header = type_.encode() + b'\x00' # deltas are only made between objects of the same type
+            obj = header + content
+            kind, entry, entry_depth = PACK_FULL, zlib.compress(obj, level), 0
+            
+            max_size = len(obj) // 2 # like git, a delta over half the object's size isn't worth it
+            for base_oid, base, base_depth in candidates:
+                if base_depth >= depth or not base.startswith(header):
+                    continue
+                # the delta has to insert at least the size difference, and a much smaller object
+                # has little to copy from the base: skip those without computing anything
+                if abs(len(base) - len(obj)) >= max_size or len(obj) < len(base) // 32:
+                    continue
+                obj_delta = delta.create_delta(base, obj, max_size)
+                if obj_delta is None:
+                    continue
+                delta_entry = bytes.fromhex(base_oid) + zlib.compress(obj_delta, level)
+                if len(delta_entry) < len(entry):
+                    kind, entry, entry_depth = PACK_DELTA, delta_entry, base_depth + 1
+                    max_size = len(obj_delta) - 1 # the next bases have to beat this delta
+            candidates.append((oid, obj, entry_depth))
+            yield oid, kind, entry
+    
+    name = _write_pack(oids, entries())
+    
+    # now that everything is safely in the new pack, remove the old copies
+    _remove_packs(pack for pack in old_packs if pack.name != name)
+    for path in loose.values():
+        os.remove(path)
+    return len(oids)
+
+# zlib-compressed chunks of 'type\0content', content being `start` followed by the rest of the file object f
+def _compress_object(type_, start, f, level):
+    compressor = zlib.compressobj(level)
+    with f:
+        yield compressor.compress(type_.encode() + b'\x00')
+        yield compressor.compress(start)
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            yield compressor.compress(chunk)
+    yield compressor.flush()
+
+# Write a new pack holding the objects `oids` and its index, returns the name of the pack.
+# entries yields (oid, kind, data) for every object, in the order they go into the pack file.
+# data is the stored entry, as bytes or as an iterable of pieces (its length is filled in once they are all written)
+def _write_pack(oids, entries):
+    oids = sorted(oids)
+    os.makedirs(_pack_dir(), exist_ok=True)
+    name = 'pack-' + hashlib.sha256(''.join(oids).encode()).hexdigest()
+    pack_path = os.path.join(_pack_dir(), name + '.pack')
+    idx_path = os.path.join(_pack_dir(), name + '.idx')
+    
+    offsets = {}
+    try:
+        with open(pack_path + '.tmp', 'wb') as out:
+            out.write(_PACK_HEADER.pack(PACK_SIGNATURE, PACK_VERSION, len(oids)))
+            for oid, kind, entry in entries:
+                offsets[oid] = out.tell()
+                if isinstance(entry, bytes):
+                    out.write(_PACK_ENTRY.pack(kind, len(entry)))
+                    out.write(entry)
+                    continue
+                out.write(_PACK_ENTRY.pack(kind, 0))
+                length = 0
+                for chunk in entry:
+                    out.write(chunk)
+                    length += len(chunk)
+                end = out.tell()
+                out.seek(offsets[oid])
+                out.write(_PACK_ENTRY.pack(kind, length))
+                out.seek(end)
+        
+        with open(idx_path + '.tmp', 'wb') as out:
+            out.write(_PACK_HEADER.pack(PACK_IDX_SIGNATURE, PACK_VERSION, len(oids)))
+            out.write(_PACK_FANOUT.pack(*_build_fanout(oids)))
+            out.write(b''.join(bytes.fromhex(oid) for oid in oids))
+            out.write(b''.join(_PACK_OFFSET.pack(offsets[oid]) for oid in oids))
+        
+        # the pack has to be in place before its index, readers only look for .idx files
+        os.replace(pack_path + '.tmp', pack_path)
+        os.replace(idx_path + '.tmp', idx_path)
+    except BaseException:
+        # don't leave half-written temp files behind (a damaged object, no space left, ctrl-c...)
+        for path in (pack_path + '.tmp', idx_path + '.tmp'):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    _load_packs.cache_clear()
+    return name
+
+# Rewrite the packs written before `expire` (a time.time() value) without the objects in `drop`,
+# returns how many objects were dropped. Packs without any of them are left alone.
+# The other entries are copied as they are, only a delta whose base is dropped is stored whole instead
+def prune_packs(drop, expire):
+    dropped = 0
+    rewritten = []
+    for pack in _load_packs():
+        if os.path.getmtime(os.path.join(_pack_dir(), pack.name + '.pack')) >= expire:
+            continue
+        kept = [oid for oid in _iter_pack_oids(pack) if oid not in drop]
+        if len(kept) == pack.count:
+            continue
+        dropped += pack.count - len(kept)
+        if kept:
+            _write_pack(kept, _copy_pack_entries(pack, drop))
+        rewritten.append(pack)
+    # only now, the entries copied above might have needed a delta base from one of these
+    _remove_packs(rewritten)
+    return dropped
+
+def _copy_pack_entries(pack, drop):
+    level = COMPRESSION_LEVEL or zlib.Z_DEFAULT_COMPRESSION
+    for oid, offset in _iter_pack_offsets(pack):
+        if oid in drop:
+            continue
+        kind, length = _PACK_ENTRY.unpack_from(pack.data, offset)
+        start = offset + _PACK_ENTRY.size
+        if kind == PACK_DELTA and pack.data[start:start + 32].hex() in drop:
+            yield oid, PACK_FULL, zlib.compress(_read_packed(pack, offset), level)
+        else:
+            view = memoryview(pack.data)[start:start + length] # copied from the mapped pack piece by piece
+            yield oid, kind, (view[i:i + CHUNK_SIZE] for i in range(0, length, CHUNK_SIZE))
+
+def _remove_packs(packs):
+    for pack in packs:
+        os.remove(os.path.join(_pack_dir(), pack.name + '.idx'))
+        os.remove(os.path.join(_pack_dir(), pack.name + '.pack'))
+    _load_packs.cache_clear()
+
+# Find the oids of all objects starting with a (hex) prefix, stops after `limit` matches
+# (2 are enough to know a prefix is ambiguous).
+# Packs are searched with a binary search in their sorted idx, for loose objects only the fan-out
+# directories the prefix can be in are listed
+def find_objects(prefix, limit=2):
+    matches = _find_objects(prefix, limit)
+    if not matches:
+        # the loose object listings are cached, an object written since they were made isn't in them
+        _sorted_loose_objects.cache_clear()
+        _flat_loose_objects.cache_clear()
+        _reload_packs()
+        matches = _find_objects(prefix, limit)
+    return matches
+
+def _find_objects(prefix, limit):
+    prefix = prefix.lower()
+    matches = set()
+    # the smallest oid that can start with the prefix: the prefix padded with zeros
+    lowest = bytes.fromhex(prefix.ljust(64, '0'))
+    
+    for pack in _load_packs():
+        oids_start = _PACK_HEADER.size + _PACK_FANOUT.size
+        i = _bisect_oid_left(pack.idx, oids_start, pack.fanout, lowest)
+        while i < pack.count and len(matches) < limit:
+            pos = oids_start + i * 32
+            oid = pack.idx[pos:pos + 32].hex()
+            if not oid.startswith(prefix):
+                break
+            matches.add(oid)
+            i += 1
+    
+    shards = [f'{i:02x}' for i in range(256) if f'{i:02x}'.startswith(prefix[:2])]
+    for shard in shards:
+        loose = _sorted_loose_objects(shard)
+        i = bisect.bisect_left(loose, prefix)
+        while i < len(loose) and loose[i].startswith(prefix) and len(matches) < limit:
+            matches.add(loose[i])
+            i += 1
+    return sorted(matches)
+
+@functools.lru_cache(maxsize=None)
+def _sorted_loose_objects(shard):
+    try:
+        names = os.listdir(os.path.join(GIT_DIR, 'objects', shard))
+    except FileNotFoundError:
+        names = []
+    oids = [shard + name for name in names if len(name) == 62]
+    oids.extend(oid for oid in _flat_loose_objects() if oid.startswith(shard))
+    return sorted(oids)
+
+@functools.lru_cache(maxsize=None)
+def _flat_loose_objects(): # objects not yet migrated to the fan-out layout
+    with os.scandir(os.path.join(GIT_DIR, 'objects')) as it:
+        return [entry.name for entry in it if len(entry.name) == 64]
+
+# The commit-graph keeps the parent, tree and generation number of commits, so history can be walked
+# without opening and parsing every commit object. It is made of two files:
+#   .ugit/commit-graph, written in one go by write_commit_graph():
+#       <header: 'UCGF', version, number of commits>
+#       <fan-out table><all commit oids, sorted, 32 raw bytes each>
+#       <one record per commit, same order as the oids: tree (32 raw bytes), position of the parent
+#        in the oid table (4 bytes, NO_PARENT if none), generation (4 bytes)>
+#   .ugit/commit-graph-tail, new commits are appended to it by append_commit_graph():
+#       <record>...<record>, each record is oid, tree, parent (32 raw bytes each, parent all zeros if none), generation
+# The generation of a commit is 1 for a root commit and (generation of the parent) + 1 otherwise.
+# Both files only contain commits whose parent is in the graph as well, so a walk can stay in the graph
+GraphCommit = namedtuple('GraphCommit', ['tree', 'parent', 'generation'])
+
+GRAPH_SIGNATURE = b'UCGF'
+GRAPH_VERSION = 1
+_GRAPH_HEADER = struct.Struct('>4sII') # signature, version, number of commits
+_GRAPH_RECORD = struct.Struct('>32sII') # tree, parent position, generation
+_GRAPH_TAIL_RECORD = struct.Struct('>32s32s32sI') # oid, tree, parent, generation
+_GRAPH_OIDS_START = _GRAPH_HEADER.size + _PACK_FANOUT.size
+NO_PARENT = 0xffffffff
+_NO_OID = bytes(32)
+
+CommitGraph = namedtuple('CommitGraph', ['data', 'count', 'fanout', 'tail'])
+
+@functools.lru_cache(maxsize=None)
+def _load_commit_graph():
+    graph_data, count, fanout = None, 0, None
+    graph_path = os.path.join(GIT_DIR, 'commit-graph')
+    if os.path.isfile(graph_path):
+        with open(graph_path, 'rb') as f:
+            graph_data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        signature, version, count = _GRAPH_HEADER.unpack_from(graph_data)
+        assert signature == GRAPH_SIGNATURE and version == GRAPH_VERSION, 'Bad commit-graph'
+        fanout = _PACK_FANOUT.unpack_from(graph_data, _GRAPH_HEADER.size)
+    
+    tail = {}
+    tail_path = os.path.join(GIT_DIR, 'commit-graph-tail')
+    if os.path.isfile(tail_path):
+        with open(tail_path, 'rb') as f:
+            buf = f.read()
+        # a crash in the middle of an append can leave a partial record at the end, ignore it
+        buf = buf[:len(buf) - len(buf) % _GRAPH_TAIL_RECORD.size]
+        for oid, tree, parent, generation in _GRAPH_TAIL_RECORD.iter_unpack(buf):
+            tail[oid.hex()] = GraphCommit(tree.hex(), parent.hex() if parent != _NO_OID else None, generation)
+    return CommitGraph(graph_data, count, fanout, tail)
+
+# returns GraphCommit for the oid, or None if the commit is not in the commit-graph
+def read_commit_graph(oid):
+    graph = _load_commit_graph()
+    if oid in graph.tail:
+        return graph.tail[oid]
+    if not graph.count:
+        return None
+    
+    i = _bisect_oid(graph.data, _GRAPH_OIDS_START, graph.fanout, bytes.fromhex(oid))
+    if i is None:
+        return None
+    return _read_graph_record(graph, i)
+
+# GraphCommit of the i-th commit in .ugit/commit-graph
+def _read_graph_record(graph, i):
+    records_start = _GRAPH_OIDS_START + graph.count * 32
+    tree, parent_pos, generation = _GRAPH_RECORD.unpack_from(graph.data, records_start + i * _GRAPH_RECORD.size)
+    parent = None
+    if parent_pos != NO_PARENT:
+        pos = _GRAPH_OIDS_START + parent_pos * 32
+        parent = graph.data[pos:pos + 32].hex()
+    return GraphCommit(tree.hex(), parent, generation)
+
+# commits: {oid: GraphCommit}, must contain the parent of every commit in it
+def write_commit_graph(commits):
+    oids = sorted(commits)
+    position = {oid: i for i, oid in enumerate(oids)}
+    graph_path = os.path.join(GIT_DIR, 'commit-graph')
+    with open(graph_path + '.lock', 'wb') as out:
+        out.write(_GRAPH_HEADER.pack(GRAPH_SIGNATURE, GRAPH_VERSION, len(oids)))
+        out.write(_PACK_FANOUT.pack(*_build_fanout(oids)))
+        out.write(b''.join(bytes.fromhex(oid) for oid in oids))
+        for oid in oids:
+            commit = commits[oid]
+            parent_pos = position[commit.parent] if commit.parent else NO_PARENT
+            out.write(_GRAPH_RECORD.pack(bytes.fromhex(commit.tree), parent_pos, commit.generation))
+    os.replace(graph_path + '.lock', graph_path)
+    # everything from the tail is in the new file now
+    tail_path = os.path.join(GIT_DIR, 'commit-graph-tail')
+    if os.path.exists(tail_path):
+        os.remove(tail_path)
+    _load_commit_graph.cache_clear()
+
+GRAPH_TAIL_MAX = 1024 # once the tail has this many commits, it is merged into .ugit/commit-graph
+
+def append_commit_graph(oid, commit): # commit: GraphCommit
+    parent = bytes.fromhex(commit.parent) if commit.parent else _NO_OID
+    with open(os.path.join(GIT_DIR, 'commit-graph-tail'), 'ab') as out:
+        out.write(_GRAPH_TAIL_RECORD.pack(bytes.fromhex(oid), bytes.fromhex(commit.tree), parent, commit.generation))
+    graph = _load_commit_graph()
+    graph.tail[oid] = commit
+    if len(graph.tail) >= GRAPH_TAIL_MAX:
+        # every ugit process parses the whole tail, don't let it grow forever
+        commits = {}
+        for i in range(graph.count):
+            pos = _GRAPH_OIDS_START + i * 32
+            commits[graph.data[pos:pos + 32].hex()] = _read_graph_record(graph, i)
+        commits.update(graph.tail)
+        write_commit_graph(commits)
+
+# .ugit/commit-graph-bloom keeps the changed-path Bloom filter (see bloom.py) of commits, one record per commit:
+#   <oid (32 raw bytes)><length of the filter (4 bytes)><filter>
+# commit appends the filter of every new commit, write_bloom_filters() rewrites the file ('ugit commit-graph').
+# A commit without a record simply has no filter, its trees are compared instead
+_BLOOM_HEADER = struct.Struct('>32sI')
+
+@functools.lru_cache(maxsize=None)
+def _load_bloom_filters():
+    filters = {}
+    try:
+        with open(os.path.join(GIT_DIR, 'commit-graph-bloom'), 'rb') as f:
+            buf = f.read()
+    except FileNotFoundError:
+        return filters
+    pos = 0
+    while pos + _BLOOM_HEADER.size <= len(buf):
+        oid, length = _BLOOM_HEADER.unpack_from(buf, pos)
+        pos += _BLOOM_HEADER.size
+        if pos + length > len(buf):
+            break # partial record left by a crash in the middle of an append
+        filters[oid.hex()] = buf[pos:pos + length]
+        pos += length
+    return filters
+
+# returns the filter of the commit, or None if it has none
+def read_bloom_filter(oid):
+    return _load_bloom_filters().get(oid)
+
+def _pack_bloom_record(oid, bits):
+    return _BLOOM_HEADER.pack(bytes.fromhex(oid), len(bits)) + bits
+
+# filters: {oid: filter}, replaces all filters stored so far
+def write_bloom_filters(filters):
+    path = os.path.join(GIT_DIR, 'commit-graph-bloom')
+    with open(path + '.lock', 'wb') as out:
+        for oid in sorted(filters):
+            out.write(_pack_bloom_record(oid, filters[oid]))
+    os.replace(path + '.lock', path)
+    _load_bloom_filters.cache_clear()
+
+def append_bloom_filter(oid, bits):
+    with open(os.path.join(GIT_DIR, 'commit-graph-bloom'), 'ab') as out:
+        out.write(_pack_bloom_record(oid, bits))
+    _load_bloom_filters.cache_clear()
+
+# The index is a stat cache: for every file snapshotted by write_tree it remembers
+# the file's stat data and the blob oid it hashed to.
+# If the stat data did not change since then, the file content did not change either
+# and write_tree can reuse the oid instead of reading and hashing the file again.
+IndexEntry = namedtuple('IndexEntry', ['mtime', 'ctime', 'size', 'ino', 'oid'])
+
+INDEX_SIGNATURE = b'UIDX'
+INDEX_VERSION = 2
+_INDEX_HEADER = struct.Struct('>4sIIH') # signature, version, number of entries, length of the watch token
+_INDEX_ENTRY = struct.Struct('>qqQQ32s') # mtime_ns, ctime_ns, size, inode, raw oid (32 bytes)
+# On disk the index looks like:
+#   <header><watch token><entry 1><entry 2>...<entry n><path 1>\0<path 2>\0...<path n>
+# all entries have the same size, so they can be unpacked in one go with iter_unpack
+# and the paths are decoded and split in one go as well.
+# The watch token is the point in time (as the filesystem watcher, see watch.py, counts it) when the
+# scan that produced this index started; it is empty if the index was not written by such a scan
+
+# entries: {path: IndexEntry} that can be trusted, racy: the ones that can't (see read_index_state)
+IndexState = namedtuple('IndexState', ['entries', 'racy', 'watch_token'])
+
+def read_index():
+    return read_index_state().entries
+
+@trace.timed('read_index')
+def read_index_state():
+    try:
+        with open(os.path.join(GIT_DIR, 'index'), 'rb') as f:
+            buf = f.read()
+            index_mtime = os.fstat(f.fileno()).st_mtime_ns
+    except FileNotFoundError:
+        return IndexState({}, {}, None)
+    
+    # unknown or damaged index (e.g. cut short by a crash): act as if there is none, everything gets hashed again
+    no_index = IndexState({}, {}, None)
+    if len(buf) < _INDEX_HEADER.size:
+        return no_index
+    signature, version, count, token_len = _INDEX_HEADER.unpack_from(buf)
+    if signature != INDEX_SIGNATURE or version != INDEX_VERSION:
+        return no_index
+    
+    start = _INDEX_HEADER.size + token_len
+    end = start + count * _INDEX_ENTRY.size
+    if end > len(buf):
+        return no_index
+    try:
+        watch_token = buf[_INDEX_HEADER.size:start].decode() or None
+        paths = buf[end:].decode().split('\0') if count else []
+    except UnicodeDecodeError:
+        return no_index
+    if len(paths) != count:
+        return no_index
+    
+    entries, racy = {}, {}
+    for path, (mtime, ctime, size, ino, oid) in zip(paths, _INDEX_ENTRY.iter_unpack(buf[start:end])):
+        entry = IndexEntry(mtime, ctime, size, ino, oid.hex())
+        if mtime >= index_mtime:
+            # "racy" entry: the file was modified in the same clock tick the index was written,
+            # it might have changed again after it was hashed without changing its stat data
+            racy[path] = entry
+        else:
+            entries[path] = entry
+    return IndexState(entries, racy, watch_token)
+
+@trace.timed('write_index')
+def write_index(entries, watch_token=None):
+    paths = sorted(entries)
+    token = (watch_token or '').encode()
+    header = _INDEX_HEADER.pack(INDEX_SIGNATURE, INDEX_VERSION, len(paths), len(token)) + token
+    body = b''.join(
+        _INDEX_ENTRY.pack(e.mtime, e.ctime, e.size, e.ino, bytes.fromhex(e.oid))
+        for e in map(entries.get, paths))
+    
+    # write to a temp file and rename it, so a crash never leaves a half written index behind
+    index_path = os.path.join(GIT_DIR, 'index')
+    with open(index_path + '.lock', 'wb') as f:
+        f.write(header + body + '\0'.join(paths).encode())
+    os.replace(index_path + '.lock', index_path)
+
+# build an index entry from os.stat() / os.DirEntry.stat() result
+def index_entry(st, oid):
+    return IndexEntry(st.st_mtime_ns, st.st_ctime_ns, st.st_size, st.st_ino, oid)
+
+def index_entry_matches(entry, st):
+    return (entry is not None
+            and entry.mtime == st.st_mtime_ns
+            and entry.ctime == st.st_ctime_ns
+            and entry.size == st.st_size
+            and entry.ino == st.st_ino)
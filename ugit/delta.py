@@ -0,0 +1,100 @@
+# Delta encoding for packs: describe an object as a list of instructions that rebuild it from another (base) object.
+# For a file where only a few lines changed between two versions, the delta is mostly
+# "copy this range from the base" instructions and is much smaller than the whole file.
+
+import struct
+
+# A delta looks like:
+#   <size of the base (8 bytes)><size of the result (8 bytes)><instruction>...<instruction>
+# and every instruction starts with one byte:
+#   0x80             -> copy: followed by <offset (4 bytes)><length (4 bytes)> of a range in the base
+#   0x01 ... 0x7f    -> insert: the byte is the number of bytes that follow and are copied as-is
+_DELTA_HEADER = struct.Struct('>QQ')
+_COPY = struct.Struct('>II')
+COPY_OP = 0x80
+MAX_INSERT = 0x7f
+MAX_COPY = 0xffffffff
+
+BLOCK_SIZE = 16 # matches between base and target are looked up in blocks of this many bytes
+
+# Returns the delta, or None as soon as it gets bigger than max_size bytes
+# (the caller already has something smaller, no need to finish a delta it will throw away)
+def create_delta(base, target, max_size=None):
+    if max_size is None:
+        max_size = len(target) * 2 + _DELTA_HEADER.size # more than any delta can be
+    # remember where each block of the base starts (the first occurrence is enough)
+    blocks = {}
+    for i in range(0, len(base) - BLOCK_SIZE + 1, BLOCK_SIZE):
+        blocks.setdefault(base[i:i + BLOCK_SIZE], i)
+    find = blocks.get
+
+    out = [_DELTA_HEADER.pack(len(base), len(target))]
+    size = _DELTA_HEADER.size # bytes in out
+    pending = 0 # target[pending:i] has no match in the base yet, it will be inserted
+
+    def flush_insert(end):
+        nonlocal size
+        for j in range(pending, end, MAX_INSERT):
+            chunk = target[j:min(j + MAX_INSERT, end)]
+            out.append(bytes([len(chunk)]) + chunk)
+            size += 1 + len(chunk)
+
+    i = 0
+    end = len(target)
+    limit = max_size - size # give up once i gets past this, the inserts alone would be too big
+    while i < end:
+        start = find(target[i:i + BLOCK_SIZE])
+        if start is None:
+            i += 1
+            if i > limit:
+                return None
+            continue
+
+        # the block matches, see how far the match goes on after it
+        length = BLOCK_SIZE
+        # compare big slices first (fast, done in C), then finish byte by byte
+        while (length + 4096 <= MAX_COPY
+               and i + length + 4096 <= len(target) and start + length + 4096 <= len(base)
+               and target[i + length:i + length + 4096] == base[start + length:start + length + 4096]):
+            length += 4096
+        while (i + length < len(target) and start + length < len(base)
+               and target[i + length] == base[start + length]
+               and length < MAX_COPY):
+            length += 1
+        # and before it: the bytes waiting to be inserted might match the base as well
+        while i > pending and start > 0 and base[start - 1] == target[i - 1] and length < MAX_COPY:
+            start -= 1
+            i -= 1
+            length += 1
+
+        flush_insert(i)
+        out.append(bytes([COPY_OP]) + _COPY.pack(start, length))
+        size += 1 + _COPY.size
+        i += length
+        pending = i
+        limit = pending + max_size - size
+    flush_insert(end)
+    if size > max_size:
+        return None
+    return b''.join(out)
+
+def apply_delta(base, delta):
+    base_size, target_size = _DELTA_HEADER.unpack_from(delta)
+    assert base_size == len(base), 'Delta does not apply to this base'
+
+    out = []
+    pos = _DELTA_HEADER.size
+    while pos < len(delta):
+        op = delta[pos]
+        pos += 1
+        if op == COPY_OP:
+            start, length = _COPY.unpack_from(delta, pos)
+            pos += _COPY.size
+            out.append(base[start:start + length])
+        else:
+            out.append(delta[pos:pos + op])
+            pos += op
+
+    result = b''.join(out)
+    assert len(result) == target_size, 'Corrupt delta'
+    return result
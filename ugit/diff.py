@@ -1,14 +1,13 @@
 # codes for dealing with computing differences between trees
 
-import subprocess
-# to spawn new processes, connect to their input/output/error pipes, and obtain their return codes
+import difflib
+# standard library module for comparing sequences, it can output unified diffs like the 'diff' command
 
 from collections import defaultdict
-from tempfile import NamedTemporaryFile as Temp
-# for creating named temporary file, which can be accessed via real file's name
-
 
+from . import base
 from . import data
+from . import trace
 
 def compare_trees(*trees): # allow n tree (diff_trees passes 2)
     entries = defaultdict(lambda: [None] * len(trees))
@@ -58,37 +57,43 @@ def diff_trees(t_from, t_to): # prev tree vs next tree
     # }
     # from base.get_tree()
     
-    output = b''
+    # this is a generator: the diff is produced piece by piece (bytes) as the caller writes it out,
+    # instead of being collected into one big bytes object first
     for path, o_from, o_to in compare_trees(t_from, t_to):
         if o_from != o_to:
-            output += diff_blobs(o_from, o_to, path)
-    return output
+            yield from diff_blobs(o_from, o_to, path)
 
-def diff_blobs(o_from, o_to, path='blob'):
-    with Temp() as f_from, Temp() as f_to:
-    # create 2 temp files as 'f_from' and 'f_to', existing only within 'with'
-    # temp files are needed since raw binary files in .ugit/objects cant be compared by 'diff'
-        for oid, f in ((o_from, f_from), (o_to, f_to)):
-            if oid:
-                f.write(data.get_object(oid))
-                f.flush()
-                # normally python will automatically flush the buffer when:
-                # closed() -> close file
-                # out of 'with'
-                # buffer overflow
-                # here files content is needed within another process
-                # which is calling 'diff' using 'subprocess'
-                
-        with subprocess.Popen( # Process open
-            ['diff', '--unified', '--show-c-function',
-             '--label', f'a/{path}', f_from.name,
-             '--label', f'b/{path}', f_to.name],
-            stdout=subprocess.PIPE) as proc:
-            # stdout=subprocess.PIPE request result to be piped into python (not printed to terminal)
-            # 'with ... as proc': context manager is used to make sure 'proc' is release when out of 'with'
-            output, _ = proc.communicate()
-            # interact with process, here send no stdin (input)
-            # read data from stdout (output) and stderr (ignored)
-            # until end-of-file is reached. Wait for process to terminate.
+# Same as diff_trees, but takes the tree oids and uses base.iter_tree_changes,
+# which only reads the subtrees that actually changed instead of flattening both trees first
+def diff_tree_oids(tree_from, tree_to):
+    for path, o_from, o_to in base.iter_tree_changes(tree_from, tree_to):
+        yield from diff_blobs(o_from, o_to, path)
+
+BINARY_CHECK_SIZE = 8000 # like git, a NUL byte in the first 8000 bytes means the file is binary
+
+def _is_binary(content):
+    return b'\x00' in content[:BINARY_CHECK_SIZE]
 
-        return output
+def diff_blobs(o_from, o_to, path='blob'):
+    # a missing side (added or deleted file) is compared as an empty file
+    a = data.get_object(o_from) if o_from else b''
+    b = data.get_object(o_to) if o_to else b''
+    trace.count('blobs_diffed')
+    trace.count('bytes_diffed', len(a) + len(b))
+    
+    if _is_binary(a) or _is_binary(b):
+        # don't bother diffing binary files line by line, nobody can read that anyway
+        yield f'Binary files a/{path} and b/{path} differ\n'.encode()
+        return
+    
+    # difflib runs in this process, no need to write temp files and start an external 'diff' for every file.
+    # diff_bytes lets unified_diff work on bytes, so files don't need to be decoded
+    lines = difflib.diff_bytes(
+        difflib.unified_diff,
+        a.splitlines(keepends=True), b.splitlines(keepends=True),
+        f'a/{path}'.encode(), f'b/{path}'.encode(), lineterm=b'\n')
+    for line in lines:
+        yield line
+        if not line.endswith(b'\n'):
+            # last line of a file without a trailing newline, same marker as 'diff' prints
+            yield b'\n\\ No newline at end of file\n'
@@ -0,0 +1,139 @@
+# Tracing: counts what ugit does (objects read and written, bytes hashed, cache hits, ref lookups...)
+# and how long each phase takes (scanning the working tree, building trees, writing files...).
+#
+# Enable it with 'ugit --trace <command>' or the UGIT_TRACE environment variable:
+#   UGIT_TRACE=1           -> print a summary table to stderr when ugit exits
+#   UGIT_TRACE=out.json    -> write a Chrome trace (open it in chrome://tracing or https://ui.perfetto.dev)
+# 'ugit --trace-file out.json <command>' does the same as the second one.
+#
+# When tracing is off, span() returns one shared do-nothing object and count() returns right away,
+# so the calls spread through data, base and diff cost next to nothing.
+
+import atexit
+import functools
+import os
+import sys
+import threading
+import time
+
+ENABLED = False
+_output = None # None -> summary table on stderr, otherwise the path of the Chrome trace to write
+_start = time.perf_counter_ns()
+_spans = [] # (name, start ns, duration ns, thread id), list.append is thread-safe
+_counters = {}
+_counters_lock = threading.Lock() # counters are updated from worker threads too (write_tree/read_tree with jobs)
+
+def enable(output=None):
+    global ENABLED, _output
+    if not ENABLED:
+        atexit.register(_report)
+    ENABLED = True
+    _output = output
+
+# add n to a counter
+def count(name, n=1):
+    if not ENABLED:
+        return
+    with _counters_lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+# time a phase:
+#   with trace.span('scan'):
+#       ...
+def span(name):
+    if not ENABLED:
+        return _NO_SPAN
+    return _Span(name)
+
+# time every call of a function, same as wrapping its whole body in span(name)
+def timed(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            with _Span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class _Span:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        _spans.append((self.name, self.start, time.perf_counter_ns() - self.start, threading.get_ident()))
+        return False
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NO_SPAN = _NoSpan()
+
+# counters kept by the modules themselves, added to the report if those modules were used at all
+def _module_counters():
+    counters = dict(_counters)
+    data = sys.modules.get(f'{__package__}.data')
+    if data:
+        counters.update(data.stats)
+    base = sys.modules.get(f'{__package__}.base')
+    if base:
+        for name, info in base.cache_info().items():
+            counters[f'{name}_cache_hits'] = info.hits
+            counters[f'{name}_cache_misses'] = info.misses
+    return counters
+
+def _report():
+    end = time.perf_counter_ns()
+    counters = _module_counters()
+    if _output:
+        _write_chrome_trace(_output, counters, end)
+    else:
+        _print_summary(counters, end)
+
+def _print_summary(counters, end):
+    out = sys.stderr
+    print(f'\nugit trace: {(end - _start) / 1e6:.2f} ms in total', file=out)
+
+    totals = {} # name -> [calls, ns]
+    for name, _, duration, _ in _spans:
+        total = totals.setdefault(name, [0, 0])
+        total[0] += 1
+        total[1] += duration
+    if totals:
+        # spans from several threads overlap, so their sum can be more than the total time
+        print(f'\n{"phase":<28}{"calls":>8}{"total ms":>12}', file=out)
+        for name, (calls, duration) in sorted(totals.items(), key=lambda item: item[1][1], reverse=True):
+            print(f'{name:<28}{calls:>8}{duration / 1e6:>12.2f}', file=out)
+
+    if counters:
+        print(f'\n{"counter":<28}{"value":>20}', file=out)
+        for name, value in sorted(counters.items()):
+            print(f'{name:<28}{value:>20}', file=out)
+
+def _write_chrome_trace(path, counters, end):
+    import json
+    pid = os.getpid()
+    events = [{'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+               'ts': (start - _start) / 1000, 'dur': duration / 1000} # microseconds
+              for name, start, duration, tid in _spans]
+    events.append({'name': 'counters', 'ph': 'C', 'pid': pid, 'tid': 0,
+                   'ts': (end - _start) / 1000, 'args': counters})
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+_env = os.environ.get('UGIT_TRACE', '')
+if _env and _env != '0':
+    enable(None if _env in ('1', 'summary') else _env)
@@ -0,0 +1,233 @@
+# Filesystem watcher daemon ('ugit watch') and its client.
+# The daemon uses Linux inotify to get told about every change in the working directory
+# and remembers which paths changed. write_tree and status ask it (over a Unix socket)
+# which paths changed since their last scan, so they only need to look at those instead of the whole tree.
+# If the daemon isn't running or can't answer, they simply do a full scan like before.
+
+import ctypes
+import ctypes.util
+import itertools
+import json
+import os
+import socket
+import struct
+import threading
+
+from collections import namedtuple
+
+from . import data
+from . import trace
+
+SOCKET_NAME = 'watch.sock' # inside GIT_DIR
+QUERY_TIMEOUT = 5 # seconds the client waits for an answer before falling back to a full scan
+COOKIE_TIMEOUT = 2 # seconds the daemon waits for its own cookie file to show up
+CLIENT_TIMEOUT = 1 # seconds the daemon waits for a client to send its request (or take its answer)
+MAX_DIRTY_PATHS = 100000 # remembering more than this isn't worth it, a full scan is about as fast
+
+# inotify constants, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+_EVENT = struct.Struct('iIII') # wd, mask, cookie, length of the name that follows
+
+# What the daemon answers:
+#   token: where the daemon's clock is now, pass it as `since` next time
+#   full:  True if the daemon can't tell what changed since `since` (unknown token, event queue overflow, ...)
+#   paths: the paths (files or directories) that changed since `since`, if full is False
+WatchResult = namedtuple('WatchResult', ['token', 'full', 'paths'])
+
+def _socket_path():
+    return os.path.join(data.GIT_DIR, SOCKET_NAME)
+
+# Ask the daemon what changed since the token `since` (None for "I know nothing").
+# Returns a WatchResult, or None if no daemon is running or it doesn't answer
+@trace.timed('watch_query')
+def query(since):
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(QUERY_TIMEOUT)
+            sock.connect(_socket_path())
+            sock.sendall(json.dumps({'since': since}).encode() + b'\n')
+            reply = _read_line(sock)
+        reply = json.loads(reply)
+        return WatchResult(reply['token'], reply['full'], reply.get('paths', []))
+    except (OSError, ValueError, KeyError):
+        return None # no socket, daemon gone, timeout, garbage... the caller falls back to a full scan
+
+def stop():
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(QUERY_TIMEOUT)
+            sock.connect(_socket_path())
+            sock.sendall(json.dumps({'stop': True}).encode() + b'\n')
+            _read_line(sock)
+        return True
+    except OSError:
+        return False
+
+def _read_line(sock):
+    buf = b''
+    while not buf.endswith(b'\n'):
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        buf += chunk
+    return buf
+
+# Run the daemon in the current process (working directory = root of the repository) until stopped
+def run():
+    watcher = _Watcher()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        os.remove(_socket_path()) # left behind by a daemon that didn't exit cleanly
+    except FileNotFoundError:
+        pass
+    server.bind(_socket_path())
+    server.listen()
+    threading.Thread(target=watcher.read_events, daemon=True).start()
+    try:
+        while True:
+            conn, _ = server.accept()
+            # one client at a time: one that connects and then says nothing must not hold up the others
+            conn.settimeout(CLIENT_TIMEOUT)
+            with conn:
+                try:
+                    request = json.loads(_read_line(conn) or b'{}')
+                    if request.get('stop'):
+                        conn.sendall(b'{}\n')
+                        break
+                    conn.sendall(json.dumps(watcher.changes_since(request.get('since'))).encode() + b'\n')
+                except (OSError, ValueError, AttributeError):
+                    # client gone before its answer (Ctrl-C, its own timeout...) or garbage request,
+                    # that's the client's problem, the daemon keeps serving the others
+                    continue
+    finally:
+        server.close()
+        os.remove(_socket_path())
+
+class _Watcher:
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        assert hasattr(libc, 'inotify_init1'), 'ugit watch needs Linux inotify'
+        self._libc = libc
+        self._fd = libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        self._lock = threading.Condition()
+        self._instance = os.urandom(8).hex() # tokens of an earlier daemon mean nothing to this one
+        self._seq = 0 # the daemon's clock, +1 for every change
+        self._reset_seq = 0 # tokens from before this point in time need a full scan
+        self._dirty = {} # path -> seq of its last change
+        self._wds = {} # watch descriptor -> directory it watches ('.', 'dir', 'dir/sub', ...)
+        self._cookies = set() # names of the cookie files seen so far
+        self._cookie_counter = itertools.count()
+
+        # GIT_DIR itself is only watched for the cookie files (see changes_since)
+        self._git_dir_wd = self._add_watch(data.GIT_DIR, IN_CREATE | IN_ONLYDIR)
+        self._watch_tree('.')
+
+    def _add_watch(self, path, mask=WATCH_MASK):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), mask)
+        if wd >= 0:
+            self._wds[wd] = path
+        return wd
+
+    # watch a directory and everything below it
+    def _watch_tree(self, directory):
+        self._add_watch(directory)
+        for root, dirnames, _ in os.walk(directory):
+            dirnames[:] = [d for d in dirnames if not _is_ignored(os.path.join(root, d))]
+            for dirname in dirnames:
+                self._add_watch(os.path.normpath(os.path.join(root, dirname)))
+
+    def _unwatch_tree(self, directory):
+        for wd, path in list(self._wds.items()):
+            if path == directory or path.startswith(directory + '/'):
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._wds[wd]
+
+    def read_events(self):
+        while True:
+            buf = os.read(self._fd, 64 * 1024)
+            with self._lock:
+                pos = 0
+                while pos < len(buf):
+                    wd, mask, _, length = _EVENT.unpack_from(buf, pos)
+                    name = buf[pos + _EVENT.size:pos + _EVENT.size + length].rstrip(b'\0').decode(errors='surrogateescape')
+                    pos += _EVENT.size + length
+                    self._handle_event(wd, mask, name)
+                self._lock.notify_all() # wake up changes_since() waiting for its cookie
+
+    def _handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            # the kernel dropped events, nobody can trust what we know anymore
+            self._reset()
+            return
+        if wd == self._git_dir_wd:
+            self._cookies.add(name)
+            return
+        if mask & IN_IGNORED: # the watch is gone (directory deleted or moved away)
+            self._wds.pop(wd, None)
+            return
+        directory = self._wds.get(wd)
+        if directory is None:
+            return
+        path = os.path.normpath(os.path.join(directory, name)) if name else directory
+        if _is_ignored(path):
+            return
+
+        self._seq += 1
+        self._dirty[path] = self._seq
+        if len(self._dirty) > MAX_DIRTY_PATHS:
+            self._reset()
+
+        if mask & IN_ISDIR:
+            # watches stick to the directory itself, not to its name, so after a move the names would be wrong
+            if mask & IN_MOVED_FROM:
+                self._unwatch_tree(path)
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self._watch_tree(path)
+
+    def _reset(self):
+        self._seq += 1
+        self._reset_seq = self._seq
+        self._dirty.clear()
+
+    def changes_since(self, since):
+        # Events from changes made right before the client asked might still be on their way.
+        # Creating a file and waiting until we get its event makes sure every earlier event was handled too
+        cookie = f'watch-cookie-{os.getpid()}-{next(self._cookie_counter)}'
+        cookie_path = os.path.join(data.GIT_DIR, cookie)
+        open(cookie_path, 'w').close()
+        try:
+            with self._lock:
+                synced = self._lock.wait_for(lambda: cookie in self._cookies, timeout=COOKIE_TIMEOUT)
+                self._cookies.discard(cookie)
+                token = f'{self._instance}:{self._seq}'
+
+                instance, _, seq = str(since or '').partition(':')
+                if not synced or instance != self._instance or not seq.isdigit() or int(seq) < self._reset_seq:
+                    return {'token': token, 'full': True} # also for tokens we can't make sense of
+                paths = [path for path, changed in self._dirty.items() if changed > int(seq)]
+                return {'token': token, 'full': False, 'paths': paths}
+        finally:
+            os.remove(cookie_path)
+
+def _is_ignored(path):
+    return data.GIT_DIR in path.split('/')